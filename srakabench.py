@@ -0,0 +1,1074 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import sys
+import tempfile
+import resource
+import time
+from types import SimpleNamespace
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+
+import srakamain
+from srakamain import CardBot, DropEngine, JsonStorage, OutboundDispatcher, RARITY_TIERS, SqliteStorage, VsrakostRanking, WriteAheadJournal
+
+RANK_SIZES = [10_000, 100_000, 1_000_000]
+RANK_QUERIES = 1000
+NAIVE_LIMIT = 100_000
+
+DROP_USERS = 2000
+DROP_REPEATS = 3
+DROP_SEND_DELAY = 0.005
+
+CONTENTION_USERS = 20
+CONTENTION_DROPS = 2000
+CONTENTION_FAIL_RATE = 0.2
+
+OUTBOUND_CHATS = 50
+OUTBOUND_MESSAGES = 20
+OUTBOUND_GLOBAL_RATE = 200
+OUTBOUND_GLOBAL_BURST = 1
+OUTBOUND_CHAT_RATE = 5.0
+OUTBOUND_CHAT_BURST = 3
+OUTBOUND_RETRY_AFTER = 1
+OUTBOUND_RETRY_AFTER_AT = (150, 600)
+OUTBOUND_NETWORK_ERROR_RATE = 0.02
+OUTBOUND_TOP_REQUESTS = 50
+OUTBOUND_PHOTOS = 10
+
+FILEID_CARDS = 5
+
+EXPORT_USERS = 1_000_000
+EXPORT_FILL_BATCH = 10_000
+EXPORT_MEMORY_LIMIT_MB = 256
+
+SHARD_WORKERS = 4
+SHARD_USERS = 500
+
+JOURNAL_RECORDS = 20_000
+JOURNAL_WRITERS = 256
+JOURNAL_SERIAL_RECORDS = 2000
+JOURNAL_MIN_RATE = 2000
+
+CRASH_ROUNDS = 6
+CRASH_USERS = 300
+CRASH_BATCH = 64
+CRASH_STATE_USERS = 20_000
+CRASH_KILL_AFTER = (0.05, 0.6)
+CRASH_START_TIMEOUT = 60
+
+DROPSTATS_CARDS = 30
+DROPSTATS_SAMPLES = 3_000_000
+DROPSTATS_PITY = 10
+CHI2_Z = 3.09
+
+BOT_USERS = 10_000
+BOT_CARDS = 30
+BOT_DROPS = 20
+BOT_QUERIES = 1000
+BOT_HANDLER_CALLS = 500
+
+REGRESSION_THRESHOLD = 0.10
+
+def make_scores(users_count, seed=0):
+    rng = random.Random(seed)
+    return {user_id: sum(rng.randint(1, 100) for _ in range(rng.randint(1, 20))) for user_id in range(users_count)}
+
+def naive_rank(scores, user_id):
+    sorted_users = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+    for rank, (uid, points) in enumerate(sorted_users, 1):
+        if uid == user_id:
+            return rank
+    return None
+
+def naive_top(scores, limit=10):
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)[:limit]
+
+def timed(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1_000_000
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def bench_ranking(sizes=RANK_SIZES):
+    results = {}
+    print(f"{'users':>10} {'build, s':>10} {'/list, us':>12} {'/top, us':>12} {'drop, us':>12} {'old /list, us':>15} {'old /top, us':>14}")
+
+    for users_count in sizes:
+        scores = make_scores(users_count)
+        rng = random.Random(1)
+        queries = [rng.randrange(users_count) for _ in range(RANK_QUERIES)]
+
+        start = time.perf_counter()
+        ranking = VsrakostRanking()
+        for user_id, points in scores.items():
+            ranking.update(user_id, points)
+        build_time = time.perf_counter() - start
+
+        query_iter = iter(queries * 2)
+        list_time = timed(lambda: ranking.rank(next(query_iter)), RANK_QUERIES)
+        top_time = timed(lambda: ranking.top(10), RANK_QUERIES)
+
+        def drop():
+            user_id = next(query_iter)
+            scores[user_id] += rng.randint(1, 100)
+            ranking.update(user_id, scores[user_id])
+        drop_time = timed(drop, RANK_QUERIES)
+
+        result = {'build_s': build_time, 'list_us': list_time, 'top_us': top_time, 'drop_us': drop_time}
+        if users_count <= NAIVE_LIMIT:
+            result['naive_list_us'] = timed(lambda: naive_rank(scores, queries[0]), 3)
+            result['naive_top_us'] = timed(lambda: naive_top(scores), 3)
+            naive_list = f"{result['naive_list_us']:15.0f}"
+            naive_top_time = f"{result['naive_top_us']:14.0f}"
+        else:
+            naive_list = f"{'-':>15}"
+            naive_top_time = f"{'-':>14}"
+        results[str(users_count)] = result
+
+        print(f"{users_count:>10} {build_time:>10.2f} {list_time:>12.1f} {top_time:>12.1f} {drop_time:>12.1f} {naive_list} {naive_top_time}")
+    return results
+
+class FakeMessage:
+    def __init__(self, log, delay=0.0, fail_rate=0.0, rng=None):
+        self.log = log
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.rng = rng or random
+
+    async def reply_text(self, text):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.log.append(('text', text))
+
+    async def reply_photo(self, photo, caption):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.fail_rate and self.rng.random() < self.fail_rate:
+            raise ConnectionError("fake send failure")
+        self.log.append(('photo', caption))
+        return SimpleNamespace(photo=[SimpleNamespace(file_id=f"fake-{len(self.log)}")])
+
+def fake_update(user_id, log, delay=0.0, fail_rate=0.0, rng=None):
+    user = SimpleNamespace(id=user_id, first_name=f"User{user_id}", last_name=None)
+    chat = SimpleNamespace(id=user_id)
+    return SimpleNamespace(effective_user=user, effective_chat=chat, message=FakeMessage(log, delay, fail_rate, rng))
+
+def make_cards_folder(base_dir, cards_count):
+    cards_path = os.path.join(base_dir, srakamain.CARDS_FOLDER)
+    os.makedirs(cards_path, exist_ok=True)
+    card_names = [f"card{i:04d}.jpg" for i in range(cards_count)]
+    for card_name in card_names:
+        with open(os.path.join(cards_path, card_name), 'wb') as f:
+            f.write(os.urandom(1024))
+    return card_names
+
+def make_state(card_names, users_count, drops_per_user, seed=0):
+    rng = random.Random(seed)
+    card_points = {card_name: rng.randint(1, 100) for card_name in card_names}
+    points = [card_points[card_name] for card_name in card_names]
+
+    user_cards = {}
+    user_vsrakost = {}
+    user_names = {}
+    for user_id in range(users_count):
+        counts = [0] * len(card_names)
+        for _ in range(drops_per_user):
+            counts[rng.randrange(len(card_names))] += 1
+        user_id_str = str(user_id)
+        user_cards[user_id_str] = counts
+        user_vsrakost[user_id_str] = sum(count * value for count, value in zip(counts, points))
+        user_names[user_id_str] = f"Игрок {user_id}"
+
+    return {
+        'user_cards': user_cards,
+        'user_cooldowns': {},
+        'user_vsrakost': user_vsrakost,
+        'user_names': user_names,
+        'card_points': card_points,
+        'card_names': card_names
+    }
+
+def make_storage(base_dir, backend):
+    if backend == 'sqlite':
+        return SqliteStorage(os.path.join(base_dir, srakamain.SQLITE_FILE))
+    return JsonStorage(os.path.join(base_dir, srakamain.DATA_FILE), backup=True)
+
+def make_bot(base_dir, backend):
+    bot = CardBot(storage=make_storage(base_dir, backend), base_dir=base_dir)
+    srakamain.card_bot = bot
+    return bot
+
+async def time_handler(handler, updates):
+    context = SimpleNamespace(application=None)
+    latencies = []
+    for update in updates:
+        start = time.perf_counter()
+        await handler(update, context)
+        latencies.append(time.perf_counter() - start)
+    return {'p50_ms': percentile(latencies, 0.5) * 1000, 'p99_ms': percentile(latencies, 0.99) * 1000}
+
+async def time_flush_on_loop(bot):
+    start = time.perf_counter()
+    flush = asyncio.create_task(bot.flush_user_data())
+    await asyncio.sleep(0)
+    on_loop = time.perf_counter() - start
+    await flush
+    return on_loop * 1000
+
+async def run_handlers(bot, users_count, calls):
+    rng = random.Random(5)
+    log = []
+    existing = [fake_update(rng.randrange(users_count), log) for _ in range(calls)]
+    fresh = [fake_update(users_count + i, log) for i in range(calls)]
+
+    await bot.start_saver(None)
+    results = {
+        'start': await time_handler(srakamain.start_command, existing),
+        'drop': await time_handler(srakamain.drop_command, fresh),
+        'drop_cooldown': await time_handler(srakamain.drop_command, fresh),
+        'list': await time_handler(srakamain.list_command, existing),
+        'top': await time_handler(srakamain.top_command, existing)
+    }
+    await bot.stop_saver(None)
+    return results
+
+def bench_bot(users_count=BOT_USERS, cards_count=BOT_CARDS, drops_per_user=BOT_DROPS, backend='json'):
+    results = {}
+    with tempfile.TemporaryDirectory() as base_dir:
+        card_names = make_cards_folder(base_dir, cards_count)
+        storage = make_storage(base_dir, backend)
+        storage.save(make_state(card_names, users_count, drops_per_user))
+        storage.close()
+
+        start = time.perf_counter()
+        bot = make_bot(base_dir, backend)
+        results['construct_ms'] = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        bot.load_user_data()
+        results['load_user_data_ms'] = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        bot.save_user_data()
+        results['save_user_data_ms'] = (time.perf_counter() - start) * 1000
+
+        rng = random.Random(6)
+        queries = [rng.randrange(users_count) for _ in range(BOT_QUERIES)]
+        query_iter = iter(queries * 2)
+        results['rank_us'] = timed(lambda: bot.get_user_vsrakost_rank(next(query_iter)), BOT_QUERIES)
+        results['top_us'] = timed(lambda: bot.get_top_users(10), BOT_QUERIES)
+        results['add_card_us'] = timed(lambda: bot.add_card_to_user(next(query_iter), rng.choice(card_names)), BOT_QUERIES)
+        results['flush_on_loop_ms'] = asyncio.run(time_flush_on_loop(bot))
+
+        for name, latency in asyncio.run(run_handlers(bot, users_count, BOT_HANDLER_CALLS)).items():
+            for key, value in latency.items():
+                results[f"{name}_{key}"] = value
+
+    print(f"bot: {users_count} users, {cards_count} cards, {drops_per_user} drops per user, {backend}")
+    for key, value in results.items():
+        print(f"   {key}: {value:.3f}")
+    return results
+
+async def run_drops(bot, users_count, repeats):
+    log = []
+    context = SimpleNamespace(application=None)
+    updates = [fake_update(user_id, log, DROP_SEND_DELAY) for user_id in range(users_count) for _ in range(repeats)]
+    random.Random(2).shuffle(updates)
+
+    latencies = []
+    semaphore = asyncio.Semaphore(srakamain.CONCURRENT_UPDATES)
+
+    async def handle(update):
+        async with semaphore:
+            start = time.perf_counter()
+            await srakamain.drop_command(update, context)
+            latencies.append(time.perf_counter() - start)
+
+    await bot.start_saver(None)
+    start = time.perf_counter()
+    await asyncio.gather(*(handle(update) for update in updates))
+    total_time = time.perf_counter() - start
+    await bot.stop_saver(None)
+    return latencies, total_time, log
+
+def bench_drops(users_count=DROP_USERS, repeats=DROP_REPEATS):
+    with tempfile.TemporaryDirectory() as base_dir:
+        make_cards_folder(base_dir, BOT_CARDS)
+        bot = make_bot(base_dir, 'json')
+
+        latencies, total_time, log = asyncio.run(run_drops(bot, users_count, repeats))
+
+        double_drops = sum(1 for user_id in bot.user_cards if bot.get_user_cards_count(user_id) > 1)
+        photos = sum(1 for kind, _ in log if kind == 'photo')
+        results = {
+            'updates': len(latencies),
+            'double_drops': double_drops,
+            'updates_per_s': len(latencies) / total_time,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000
+        }
+        print(f"updates: {len(latencies)}, photos: {photos}, double drops: {double_drops}")
+        print(f"throughput: {results['updates_per_s']:.0f} updates/s")
+        print(f"p50: {results['p50_ms']:.2f} ms, p99: {results['p99_ms']:.2f} ms")
+        return results
+
+async def run_contention(bot, users_count, drops_per_user, fail_rate):
+    rng = random.Random(7)
+    context = SimpleNamespace(application=None)
+    logs = {user_id: [] for user_id in range(users_count)}
+    rounds = []
+    for round_index in range(2):
+        updates = [
+            fake_update(user_id, logs[user_id], DROP_SEND_DELAY, fail_rate if round_index == 0 else 0.0, rng)
+            for user_id in range(users_count) for _ in range(drops_per_user)
+        ]
+        rng.shuffle(updates)
+        start = time.perf_counter()
+        await asyncio.gather(*(srakamain.drop_command(update, context) for update in updates))
+        rounds.append(time.perf_counter() - start)
+    return logs, rounds
+
+def bench_contention(users_count=CONTENTION_USERS, drops_per_user=CONTENTION_DROPS, fail_rate=CONTENTION_FAIL_RATE, backend='json'):
+    with tempfile.TemporaryDirectory() as base_dir:
+        make_cards_folder(base_dir, BOT_CARDS)
+        bot = make_bot(base_dir, backend)
+        logs, rounds = asyncio.run(run_contention(bot, users_count, drops_per_user, fail_rate))
+
+        photos = {user_id: sum(1 for kind, _ in log if kind == 'photo') for user_id, log in logs.items()}
+        double_drops = sum(1 for user_id in logs if bot.get_user_cards_count(user_id) > 1)
+        lost_cards = sum(1 for user_id in logs if bot.get_user_cards_count(user_id) != photos[user_id])
+        stuck = sum(1 for user_id in logs if not photos[user_id] and not bot.can_open_card(user_id)[0])
+        released = srakamain.metrics.counters['drop.released']
+        results = {
+            'updates': 2 * users_count * drops_per_user,
+            'double_drops': double_drops,
+            'lost_cards': lost_cards,
+            'stuck_cooldowns': stuck,
+            'released': released,
+            'round_s': rounds[0]
+        }
+    print(f"updates: {results['updates']} ({users_count} users x {drops_per_user} concurrent drops, 2 rounds), released reservations: {released}")
+    print(f"double drops: {double_drops}, cards without photo: {lost_cards}, cooldowns left without a card: {stuck}")
+    print(f"round time: {rounds[0]:.2f} s")
+    return results
+
+class ConnectError(Exception):
+    pass
+
+class FakeBotApi:
+    def __init__(self, rng):
+        self.rng = rng
+        self.calls = 0
+        self.sent = []
+        self.retry_windows = []
+        self.photo_calls = {}
+
+    async def send_message(self, chat_id, text):
+        self.calls += 1
+        now = time.monotonic()
+        if self.calls in OUTBOUND_RETRY_AFTER_AT:
+            self.retry_windows.append((now, now + OUTBOUND_RETRY_AFTER))
+            raise RetryAfter(OUTBOUND_RETRY_AFTER)
+        if self.rng.random() < OUTBOUND_NETWORK_ERROR_RATE:
+            raise NetworkError("fake network error")
+        await asyncio.sleep(0)
+        self.sent.append((now, chat_id, text))
+        return text
+
+    async def send_photo(self, chat_id, unsent):
+        self.photo_calls[chat_id] = self.photo_calls.get(chat_id, 0) + 1
+        if self.photo_calls[chat_id] == 1:
+            if unsent:
+                raise NetworkError("httpx.ConnectError: fake") from ConnectError()
+            raise TimedOut("fake timeout")
+        return chat_id
+
+def max_in_window(times, window=1.0):
+    times = sorted(times)
+    best = 0
+    start = 0
+    for end, value in enumerate(times):
+        while value - times[start] >= window:
+            start += 1
+        best = max(best, end - start + 1)
+    return best
+
+async def run_outbound(chats, messages):
+    api = FakeBotApi(random.Random(8))
+    dispatcher = OutboundDispatcher(global_rate=OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE, chat_burst=OUTBOUND_CHAT_BURST, backoff=0.05,
+                                    global_burst=OUTBOUND_GLOBAL_BURST)
+    dispatcher.start()
+    depth = []
+
+    async def sample_depth():
+        while True:
+            depth.append(len(dispatcher.jobs))
+            await asyncio.sleep(0.05)
+
+    sampler = asyncio.create_task(sample_depth())
+    start = time.perf_counter()
+    sends = [
+        dispatcher.send(chat_id, lambda chat_id=chat_id, i=i: api.send_message(chat_id, f"message {i}"))
+        for i in range(messages) for chat_id in range(chats)
+    ]
+    sends += [
+        dispatcher.send(-1, lambda: api.send_message(-1, "top"), coalesce_key=('top', -1))
+        for _ in range(OUTBOUND_TOP_REQUESTS)
+    ]
+    photos = [
+        dispatcher.send(-2 - i, lambda i=i: api.send_photo(-2 - i, unsent=i % 2 == 0), resend=False)
+        for i in range(OUTBOUND_PHOTOS)
+    ]
+    results = await asyncio.gather(*sends, return_exceptions=True)
+    await asyncio.gather(*photos, return_exceptions=True)
+    total_time = time.perf_counter() - start
+    sampler.cancel()
+    await dispatcher.stop()
+    return api, results, total_time, depth
+
+def bench_outbound(chats=OUTBOUND_CHATS, messages=OUTBOUND_MESSAGES):
+    api, results, total_time, depth = asyncio.run(run_outbound(chats, messages))
+
+    failed = sum(1 for result in results if isinstance(result, BaseException))
+    delivered = sum(1 for _, chat_id, _ in api.sent if chat_id >= 0)
+    top_sends = sum(1 for _, chat_id, _ in api.sent if chat_id == -1)
+    by_chat = {}
+    for sent_at, chat_id, _ in api.sent:
+        by_chat.setdefault(chat_id, []).append(sent_at)
+    chat_peak = max(max_in_window(times) for times in by_chat.values())
+    global_peak = max_in_window([sent_at for sent_at, _, _ in api.sent])
+    during_retry_after = sum(1 for sent_at, _, _ in api.sent for begin, end in api.retry_windows if begin < sent_at < end)
+    resent_timeouts = sum(1 for chat_id, calls in api.photo_calls.items() if chat_id % 2 and calls > 1)
+    retried_unsent = sum(1 for chat_id, calls in api.photo_calls.items() if chat_id % 2 == 0 and calls == 2)
+
+    results = {
+        'messages': chats * messages,
+        'delivered': delivered,
+        'failed': failed,
+        'top_sends': top_sends,
+        'chat_peak_per_s': chat_peak,
+        'global_peak_per_s': global_peak,
+        'sent_during_retry_after': during_retry_after,
+        'resent_timeouts': resent_timeouts,
+        'retried_unsent': retried_unsent,
+        'max_depth': max(depth) if depth else 0,
+        'total_s': total_time,
+        'ok': (delivered + failed == chats * messages and top_sends == 1
+               and chat_peak <= OUTBOUND_CHAT_BURST + OUTBOUND_CHAT_RATE
+               and global_peak <= OUTBOUND_GLOBAL_RATE + OUTBOUND_GLOBAL_BURST and not during_retry_after
+               and not resent_timeouts and retried_unsent == OUTBOUND_PHOTOS // 2)
+    }
+    print(f"messages: {results['messages']} to {chats} chats, delivered: {delivered}, failed after retries: {failed}")
+    print(f"/top requests: {OUTBOUND_TOP_REQUESTS}, sent: {top_sends}")
+    print(f"peak per chat: {chat_peak}/s (limit {OUTBOUND_CHAT_RATE:g}/s, burst {OUTBOUND_CHAT_BURST}), peak global: {global_peak}/s (limit {OUTBOUND_GLOBAL_RATE}/s, burst {OUTBOUND_GLOBAL_BURST})")
+    print(f"429 responses: {len(api.retry_windows)}, sent while blocked: {during_retry_after}, max queue depth: {results['max_depth']}")
+    print(f"photos: {OUTBOUND_PHOTOS}, resent after timeout: {resent_timeouts}, retried after connect error: {retried_unsent}")
+    print(f"total: {total_time:.2f} s -> {'OK' if results['ok'] else 'FAIL'}")
+    return results
+
+class FakePhotoApi:
+    def __init__(self):
+        self.uploads = 0
+        self.by_file_id = 0
+        self.rejected = set()
+
+    async def reply_photo(self, photo, caption):
+        if isinstance(photo, str):
+            if photo in self.rejected:
+                raise BadRequest("Wrong file identifier/http url specified")
+            self.by_file_id += 1
+            return SimpleNamespace(photo=[SimpleNamespace(file_id=photo)])
+        self.uploads += 1
+        return SimpleNamespace(photo=[SimpleNamespace(file_id=f"file-{self.uploads}")])
+
+async def send_all_cards(bot, api, card_names):
+    uploads, by_file_id = api.uploads, api.by_file_id
+    for card_name in card_names:
+        await bot.send_card(api, card_name, caption=card_name)
+    return api.uploads - uploads, api.by_file_id - by_file_id
+
+async def run_fileid(base_dir, card_names):
+    api = FakePhotoApi()
+    bot = make_bot(base_dir, 'json')
+    steps = {
+        'first': await send_all_cards(bot, api, card_names),
+        'second': await send_all_cards(bot, api, card_names)
+    }
+
+    bot = make_bot(base_dir, 'json')
+    steps['restart'] = await send_all_cards(bot, api, card_names)
+
+    cards_path = os.path.join(base_dir, srakamain.CARDS_FOLDER)
+    with open(os.path.join(cards_path, card_names[0]), 'ab') as f:
+        f.write(b'resized')
+    stat = os.stat(os.path.join(cards_path, card_names[1]))
+    os.utime(os.path.join(cards_path, card_names[1]), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    await bot.reload_cards()
+    steps['changed'] = await send_all_cards(bot, api, card_names)
+
+    stale = bot.get_card(card_names[2]).file_id
+    api.rejected.add(stale)
+    steps['stale'] = await send_all_cards(bot, api, card_names)
+    cached = bot.file_id_cache.load()
+    steps['stale_dropped'] = (cached[card_names[2]]['file_id'] != stale, bot.get_card(card_names[2]).file_id != stale)
+    return steps
+
+def bench_fileid(cards_count=FILEID_CARDS):
+    with tempfile.TemporaryDirectory() as base_dir:
+        card_names = make_cards_folder(base_dir, cards_count)
+        steps = asyncio.run(run_fileid(base_dir, card_names))
+
+    expected = {
+        'first': (cards_count, 0),
+        'second': (0, cards_count),
+        'restart': (0, cards_count),
+        'changed': (2, cards_count - 2),
+        'stale': (1, cards_count - 1),
+        'stale_dropped': (True, True)
+    }
+    results = {'steps': {name: list(value) for name, value in steps.items()}, 'ok': steps == expected}
+    for name, value in steps.items():
+        label = "cache entry replaced" if name == 'stale_dropped' else "uploads, by file_id"
+        print(f"{name}: {label} {value} (expected {expected[name]})")
+    print(f"file_id cache -> {'OK' if results['ok'] else 'FAIL'}")
+    return results
+
+def fill_sqlite(storage, card_names, users_count, drops_per_user, seed=0):
+    rng = random.Random(seed)
+    card_points = {card_name: rng.randint(1, 100) for card_name in card_names}
+    points = [card_points[card_name] for card_name in card_names]
+    storage.save({'card_points': card_points, 'card_names': card_names})
+
+    for start in range(0, users_count, EXPORT_FILL_BATCH):
+        rows = []
+        for user_id in range(start, min(start + EXPORT_FILL_BATCH, users_count)):
+            counts = [0] * len(card_names)
+            for _ in range(rng.randint(0, 2 * drops_per_user)):
+                counts[rng.randrange(len(card_names))] += 1
+            score = sum(count * value for count, value in zip(counts, points))
+            rows.append((user_id, f"Игрок {user_id}", score, None, json.dumps(counts)))
+        with storage.lock:
+            storage.conn.execute("BEGIN")
+            storage.conn.executemany(storage.UPSERT_USER, rows)
+            storage.conn.execute("COMMIT")
+
+def bench_export(users_count=EXPORT_USERS, cards_count=BOT_CARDS, drops_per_user=BOT_DROPS):
+    with tempfile.TemporaryDirectory() as base_dir:
+        card_names = [f"card{i:04d}.jpg" for i in range(cards_count)]
+        storage = make_storage(base_dir, 'sqlite')
+        start = time.perf_counter()
+        fill_sqlite(storage, card_names, users_count, drops_per_user)
+        fill_time = time.perf_counter() - start
+
+        out_dir = os.path.join(base_dir, srakamain.EXPORT_FOLDER)
+        start = time.perf_counter()
+        summary = srakamain.export_collections(storage, out_dir)
+        export_time = time.perf_counter() - start
+        storage.close()
+
+        with open(os.path.join(out_dir, f"users-00000.csv"), encoding='utf-8') as f:
+            first_chunk_ok = sum(1 for _ in f) == min(users_count, srakamain.EXPORT_CHUNK_SIZE) + 1
+        export_mb = sum(entry.stat().st_size for entry in os.scandir(out_dir)) / 2 ** 20
+
+    totals_ok = summary['users'] == users_count and sum(card['vsrakost'] for card in summary['cards']) == summary['total_vsrakost']
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    results = {
+        'fill_s': fill_time,
+        'export_s': export_time,
+        'users_per_s': users_count / export_time,
+        'peak_mb': peak_mb,
+        'export_mb': export_mb,
+        'ok': totals_ok and first_chunk_ok and peak_mb < EXPORT_MEMORY_LIMIT_MB
+    }
+    print(f"export: {users_count} users, {cards_count} cards, numpy: {'yes' if srakamain.np is not None else 'no'}")
+    print(f"fill: {fill_time:.1f} s, export: {export_time:.1f} s ({results['users_per_s']:.0f} users/s), files: {export_mb:.0f} MB")
+    print(f"peak RSS: {peak_mb:.1f} MB (limit {EXPORT_MEMORY_LIMIT_MB}), totals -> {'OK' if totals_ok else 'FAIL'}")
+    print(f"duplicate rate: {summary['duplicate_rate'] * 100:.1f}%, score p50/p90/p99: {'/'.join(str(value) for value in summary['score_percentiles'].values())}")
+    return results
+
+class FakeShardBot:
+    defaults = None
+
+    def __init__(self, log):
+        self.log = log
+
+    async def send_photo(self, chat_id, photo, caption=None, **kwargs):
+        self.log.append(('photo', caption))
+        return SimpleNamespace(photo=[SimpleNamespace(file_id=f"fake-{len(self.log)}")])
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.log.append(('text', text))
+        return SimpleNamespace(photo=None)
+
+class FakeApplication:
+    def __init__(self, bot, handlers):
+        self.bot = bot
+        self.handlers = handlers
+        self.bot_data = {}
+        self.update_queue = None
+        self.consumer = None
+        self.tasks = set()
+        self.processed = 0
+
+    async def __aenter__(self):
+        self.update_queue = asyncio.Queue()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def handle(self, handler, update):
+        await handler(update, SimpleNamespace(application=self))
+        self.processed += 1
+
+    async def consume(self):
+        while True:
+            update = await self.update_queue.get()
+            if update is None:
+                break
+            handler = self.handlers[update.message.text.split()[0].lstrip('/')]
+            task = asyncio.create_task(self.handle(handler, update))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        await asyncio.gather(*self.tasks)
+
+    async def start(self):
+        self.consumer = asyncio.create_task(self.consume())
+
+    async def stop(self):
+        await self.update_queue.put(None)
+        await self.consumer
+
+def run_shard_worker(base_dir, shard_index, shard_count, updates, results):
+    logging.getLogger('srakamain').setLevel(logging.WARNING)
+    srakamain.OUTBOUND_GLOBAL_RATE = 0
+    storage = SqliteStorage(os.path.join(base_dir, srakamain.SQLITE_FILE))
+    srakamain.card_bot = CardBot(storage=storage, base_dir=base_dir, shard=(shard_index, shard_count))
+    log = []
+    application = FakeApplication(FakeShardBot(log), {'drop': srakamain.drop_command})
+    start = time.perf_counter()
+    asyncio.run(srakamain.process_shard_updates(application, updates))
+    results.put((application.processed, sum(1 for kind, _ in log if kind == 'photo'), time.perf_counter() - start))
+
+def drop_update_body(update_id, user_id):
+    return json.dumps({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"},
+            'text': '/drop'
+        }
+    }).encode()
+
+async def post_webhook_updates(queues, users_count, repeats):
+    server = await asyncio.start_server(lambda reader, writer: srakamain.handle_webhook(reader, writer, queues), '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    bodies = [drop_update_body(update_id, user_id) for update_id, user_id in enumerate(list(range(users_count)) * repeats)]
+    random.Random(8).shuffle(bodies)
+    semaphore = asyncio.Semaphore(64)
+
+    async def post(body):
+        async with semaphore:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'POST / HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body))
+            await writer.drain()
+            status = await reader.readline()
+            writer.close()
+            await writer.wait_closed()
+            return status.split()[1] == b'200'
+
+    async with server:
+        accepted = await asyncio.gather(*(post(body) for body in bodies))
+    return sum(accepted)
+
+def bench_shards(workers=SHARD_WORKERS, users_count=SHARD_USERS, repeats=DROP_REPEATS):
+    with tempfile.TemporaryDirectory() as base_dir:
+        make_cards_folder(base_dir, BOT_CARDS)
+        coordinator = CardBot(storage=make_storage(base_dir, 'sqlite'), base_dir=base_dir)
+        coordinator.save_user_data()
+        coordinator.storage.close()
+
+        context = multiprocessing.get_context('spawn')
+        results_queue = context.Queue()
+        queues = [context.Queue() for _ in range(workers)]
+        processes = [
+            context.Process(target=run_shard_worker, args=(base_dir, shard_index, workers, queues[shard_index], results_queue))
+            for shard_index in range(workers)
+        ]
+        start = time.perf_counter()
+        for process in processes:
+            process.start()
+        accepted = asyncio.run(post_webhook_updates(queues, users_count, repeats))
+        for updates in queues:
+            updates.put(None)
+        for process in processes:
+            process.join()
+        worker_results = [results_queue.get() for process in processes if process.exitcode == 0]
+        total_time = time.perf_counter() - start
+
+        storage = make_storage(base_dir, 'sqlite')
+        data = storage.load()
+        storage.close()
+
+        card_points = data['card_points']
+        card_names = data['card_names']
+        double_drops = sum(1 for cards in data['user_cards'].values() if sum(cards) > 1)
+        db_cards = sum(sum(cards) for cards in data['user_cards'].values())
+        wrong_points = 0
+        for user_id_str, cards in data['user_cards'].items():
+            expected = sum(count * card_points[card_names[card_id]] for card_id, count in enumerate(cards))
+            if data['user_vsrakost'].get(user_id_str, 0) != expected:
+                wrong_points += 1
+        expected_top = sorted(((int(user_id_str), points) for user_id_str, points in data['user_vsrakost'].items()), key=lambda item: (-item[1], item[0]))[:10]
+
+        merged_bot = CardBot(storage=make_storage(base_dir, 'sqlite'), base_dir=base_dir)
+        top_ok = merged_bot.get_top_users(10) == expected_top
+        merged_bot.storage.close()
+
+        updates = sum(result[0] for result in worker_results)
+        photos = sum(result[1] for result in worker_results)
+        results = {
+            'updates': updates,
+            'accepted': accepted,
+            'failed_workers': workers - len(worker_results),
+            'photos': photos,
+            'db_cards': db_cards,
+            'double_drops': double_drops,
+            'wrong_points': wrong_points,
+            'updates_per_s': updates / total_time,
+            'top_ok': top_ok
+        }
+        print(f"workers: {workers}, webhook accepted: {accepted}, updates: {updates}, photos: {photos} (users {users_count}), cards in db: {db_cards}, double drops: {double_drops}")
+        print(f"users with wrong points: {wrong_points}, merged top -> {'OK' if top_ok else 'FAIL'}")
+        print(f"throughput: {results['updates_per_s']:.0f} updates/s")
+        return results
+
+async def run_journal(journal, writers, records_per_writer):
+    async def writer(user_id):
+        for _ in range(records_per_writer):
+            lsn = journal.append({'t': 'drop', 'u': user_id, 'c': 'card0000.jpg', 'p': 1, 'at': time.time()})
+            await journal.wait(lsn)
+
+    journal.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(writer(user_id) for user_id in range(writers)))
+    total_time = time.perf_counter() - start
+    await journal.stop()
+    return total_time
+
+def bench_journal(records=JOURNAL_RECORDS, writers=JOURNAL_WRITERS, serial_records=JOURNAL_SERIAL_RECORDS):
+    results = {}
+    with tempfile.TemporaryDirectory() as base_dir:
+        for name, writers_count, records_count, group_size, group_delay in (
+            ('serial', 1, serial_records, 1, 0),
+            ('group', writers, records, srakamain.JOURNAL_GROUP_SIZE, srakamain.JOURNAL_GROUP_DELAY)
+        ):
+            path = os.path.join(base_dir, f"{name}.journal")
+            journal = WriteAheadJournal(path, group_size=group_size, group_delay=group_delay)
+            commits_before = srakamain.metrics.counters['journal.commits']
+            total_time = asyncio.run(run_journal(journal, writers_count, records_count // writers_count))
+            journal.close()
+
+            written = writers_count * (records_count // writers_count)
+            fsyncs = srakamain.metrics.counters['journal.commits'] - commits_before
+            replayed = WriteAheadJournal(path).recover(0)
+            results[name] = {
+                'records': written,
+                'fsyncs': fsyncs,
+                'group_avg': written / max(1, fsyncs),
+                'records_per_s': written / total_time,
+                'replay_ok': [record['lsn'] for record in replayed] == list(range(1, written + 1))
+            }
+            print(f"{name}: {written} records from {writers_count} writers, {fsyncs} fsyncs (avg group {results[name]['group_avg']:.1f}), "
+                  f"{results[name]['records_per_s']:.0f} records/s, replay {'OK' if results[name]['replay_ok'] else 'FAIL'}")
+    return results
+
+async def run_crash_drops(bot, ack_path, seed):
+    rng = random.Random(seed)
+    context = SimpleNamespace(application=None)
+    log = []
+
+    async def drop(user_id, acks):
+        await srakamain.drop_command(fake_update(user_id, log), context)
+        acks.write(f"{user_id} {bot.user_card_totals.get(user_id, 0)}\n")
+        acks.flush()
+
+    await bot.start_saver(None)
+    with open(ack_path, 'a', encoding='utf-8') as acks:
+        while True:
+            await asyncio.gather(*(drop(user_id, acks) for user_id in rng.sample(range(CRASH_USERS), CRASH_BATCH)))
+
+def run_crash_worker(base_dir, ack_path, seed):
+    logging.getLogger('srakamain').setLevel(logging.ERROR)
+    srakamain.COOLDOWN_MINUTES = 0
+    srakamain.SAVE_INTERVAL_SECONDS = 0.05
+    srakamain.JOURNAL_CHECKPOINT_BYTES = 16 * 1024
+    bot = make_bot(base_dir, 'json')
+    asyncio.run(run_crash_drops(bot, ack_path, seed))
+
+def read_acks(ack_path):
+    acked = {}
+    with open(ack_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 2 and line.endswith('\n'):
+                user_id, total = int(parts[0]), int(parts[1])
+                acked[user_id] = max(acked.get(user_id, 0), total)
+    return acked
+
+def wait_for_acks(process, ack_path, size, timeout=CRASH_START_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and process.is_alive():
+        if os.path.getsize(ack_path) > size:
+            return True
+        time.sleep(0.01)
+    return False
+
+def bench_crash(rounds=CRASH_ROUNDS):
+    rng = random.Random(9)
+    results = {'rounds': rounds, 'acked_drops': 0, 'lost_drops': 0, 'wrong_points': 0, 'recovery_failures': 0,
+               'corrupt_snapshots': 0, 'corrupt_preserved': 0, 'torn_journals': 0}
+    with tempfile.TemporaryDirectory() as base_dir:
+        card_names = make_cards_folder(base_dir, BOT_CARDS)
+        storage = make_storage(base_dir, 'json')
+        storage.save(make_state(card_names, CRASH_STATE_USERS, BOT_DROPS))
+        ack_path = os.path.join(base_dir, 'acks.txt')
+        open(ack_path, 'w').close()
+        data_path = os.path.join(base_dir, srakamain.DATA_FILE)
+        journal_path = os.path.join(base_dir, srakamain.JOURNAL_FILE)
+
+        context = multiprocessing.get_context('spawn')
+        for round_index in range(rounds):
+            process = context.Process(target=run_crash_worker, args=(base_dir, ack_path, round_index))
+            process.start()
+            started = wait_for_acks(process, ack_path, os.path.getsize(ack_path))
+            if started:
+                time.sleep(rng.uniform(*CRASH_KILL_AFTER))
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGKILL)
+            process.join()
+            if not started:
+                results['recovery_failures'] += 1
+                print(f"round {round_index}: worker did not start (exit code {process.exitcode})")
+                continue
+
+            injected = ''
+            if round_index % 3 == 1 and os.path.exists(data_path):
+                with open(data_path, 'r+b') as f:
+                    f.truncate(os.path.getsize(data_path) // 2)
+                results['corrupt_snapshots'] += 1
+                injected = ', snapshot truncated'
+            elif round_index % 3 == 2:
+                with open(journal_path, 'ab') as f:
+                    f.write(b'00000000 {"lsn":')
+                results['torn_journals'] += 1
+                injected = ', torn journal tail'
+
+            acked = read_acks(ack_path)
+            try:
+                bot = make_bot(base_dir, 'json')
+            except Exception as e:
+                results['recovery_failures'] += 1
+                print(f"round {round_index}: recovery failed: {e}")
+                break
+
+            lost = sum(1 for user_id, total in acked.items() if bot.user_card_totals.get(user_id, 0) < total)
+            wrong = 0
+            for user_id, counts in bot.user_cards.items():
+                expected = sum(count * bot.card_points.get(bot.card_names[card_id], 0) for card_id, count in enumerate(counts))
+                if bot.user_vsrakost.get(user_id, 0) != expected:
+                    wrong += 1
+            bot.journal.close()
+            bot.storage.close()
+
+            results['acked_drops'] = sum(acked.values())
+            results['lost_drops'] += lost
+            results['wrong_points'] += wrong
+            print(f"round {round_index}: killed after {len(acked)} users acked{injected}, lost acked drops: {lost}, wrong points: {wrong}")
+
+        results['corrupt_preserved'] = sum(1 for name in os.listdir(base_dir) if name.startswith(f"{srakamain.DATA_FILE}.corrupt-"))
+    print(f"rounds: {rounds}, lost acked drops: {results['lost_drops']}, wrong points: {results['wrong_points']}, "
+          f"recovery failures: {results['recovery_failures']}, corrupt snapshots preserved: {results['corrupt_preserved']}/{results['corrupt_snapshots']}")
+    return results
+
+def chi2_critical(df, z=CHI2_Z):
+    return df * (1 - 2 / (9 * df) + z * (2 / (9 * df)) ** 0.5) ** 3
+
+def tier_weight(points):
+    for min_points, weight in RARITY_TIERS:
+        if points >= min_points:
+            return weight
+    return 1
+
+def bench_dropstats(samples=DROPSTATS_SAMPLES):
+    rng = random.Random(3)
+    card_points = {f"card{i}.jpg": rng.randint(1, 100) for i in range(DROPSTATS_CARDS)}
+    weights = {card: tier_weight(points) for card, points in card_points.items()}
+    rare_cards = [card for card, points in card_points.items() if points >= srakamain.PITY_MIN_POINTS]
+
+    engine = DropEngine(rng=random.Random(4))
+    engine.build(weights, rare_cards)
+    table = engine.table
+    total_weight = sum(weights.values())
+
+    counts = [0] * len(table)
+    sample_index = table.sample_index
+    engine_rng = engine.rng
+    start = time.perf_counter()
+    for _ in range(samples):
+        counts[sample_index(engine_rng)] += 1
+    sample_time = time.perf_counter() - start
+
+    chi2 = 0.0
+    max_error = 0.0
+    for i, card in enumerate(table.items):
+        expected = samples * weights[card] / total_weight
+        chi2 += (counts[i] - expected) ** 2 / expected
+        max_error = max(max_error, abs(counts[i] - expected) / expected)
+    critical = chi2_critical(len(table) - 1)
+    distribution_ok = chi2 < critical
+
+    pity_engine = DropEngine(rng=random.Random(5), pity_threshold=DROPSTATS_PITY)
+    pity_engine.build(weights, rare_cards)
+    longest_streak = 0
+    for user_id in range(100):
+        streak = 0
+        for _ in range(1000):
+            if pity_engine.draw(user_id) in pity_engine.rare_cards:
+                streak = 0
+            else:
+                streak += 1
+                longest_streak = max(longest_streak, streak)
+    pity_ok = longest_streak < DROPSTATS_PITY
+
+    print(f"samples: {samples}, {samples / sample_time / 1_000_000:.2f} M/s")
+    print(f"chi2: {chi2:.1f} (critical {critical:.1f}), max relative error: {max_error * 100:.2f}% -> {'OK' if distribution_ok else 'FAIL'}")
+    print(f"longest streak without rare card: {longest_streak} (pity {DROPSTATS_PITY}) -> {'OK' if pity_ok else 'FAIL'}")
+    return {
+        'samples_per_s': samples / sample_time,
+        'chi2': chi2,
+        'longest_streak': longest_streak,
+        'ok': distribution_ok and pity_ok
+    }
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    current = flatten(results)
+    previous = flatten(baseline)
+    regressions = []
+
+    print(f"{'metric':<45} {'baseline':>12} {'current':>12} {'change':>9}")
+    for name in sorted(current.keys() & previous.keys()):
+        old, new = previous[name], current[name]
+        if not old or not name.endswith(('_ms', '_us', '_s')):
+            continue
+        change = (new - old) / old
+        worse = change < -threshold if name.endswith('_per_s') else change > threshold
+        if worse:
+            regressions.append(name)
+        print(f"{name:<45} {old:>12.3f} {new:>12.3f} {change * 100:>8.1f}%{'  <- regression' if worse else ''}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for srakamain")
+    parser.add_argument('command', nargs='?', default='all', choices=['all', 'ranking', 'bot', 'drops', 'contention', 'outbound', 'fileid', 'shards', 'journal', 'crash', 'export', 'dropstats'])
+    parser.add_argument('--sizes', type=int, nargs='+', default=RANK_SIZES, help="user counts for the ranking benchmark")
+    parser.add_argument('--users', type=int, default=BOT_USERS)
+    parser.add_argument('--cards', type=int, default=BOT_CARDS)
+    parser.add_argument('--drops', type=int, default=BOT_DROPS, help="drops per synthetic user")
+    parser.add_argument('--backend', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--workers', type=int, default=SHARD_WORKERS, help="worker processes for the shards scenario")
+    parser.add_argument('--export-users', type=int, default=EXPORT_USERS, help="users in the export dataset")
+    parser.add_argument('--samples', type=int, default=DROPSTATS_SAMPLES)
+    parser.add_argument('--json', dest='json_path', help="write results to this file")
+    parser.add_argument('--compare', help="results file of a previous run to compare against")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args()
+
+    srakamain.setup_logging()
+    logging.getLogger('srakamain').setLevel(logging.WARNING)
+
+    results = {}
+    if args.command in ('ranking', 'all'):
+        results['ranking'] = bench_ranking(args.sizes)
+    if args.command in ('bot', 'all'):
+        results['bot'] = bench_bot(args.users, args.cards, args.drops, args.backend)
+    if args.command in ('drops', 'all'):
+        results['drops'] = bench_drops()
+    if args.command in ('contention', 'all'):
+        results['contention'] = bench_contention(backend=args.backend)
+    if args.command in ('outbound', 'all'):
+        results['outbound'] = bench_outbound()
+    if args.command in ('fileid', 'all'):
+        results['fileid'] = bench_fileid()
+    if args.command in ('shards', 'all'):
+        results['shards'] = bench_shards(args.workers)
+    if args.command in ('journal', 'all'):
+        results['journal'] = bench_journal()
+    if args.command in ('crash', 'all'):
+        results['crash'] = bench_crash()
+    if args.command in ('export', 'all'):
+        results['export'] = bench_export(args.export_users, args.cards, args.drops)
+    if args.command in ('dropstats', 'all'):
+        results['dropstats'] = bench_dropstats(args.samples)
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2, sort_keys=True)
+
+    failed = False
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            failed = bool(compare(results, json.load(f), args.threshold))
+    if 'dropstats' in results and not results['dropstats']['ok']:
+        failed = True
+    if 'drops' in results and results['drops']['double_drops']:
+        failed = True
+    if 'contention' in results:
+        contention = results['contention']
+        if contention['double_drops'] or contention['lost_cards'] or contention['stuck_cooldowns']:
+            failed = True
+    if 'outbound' in results and not results['outbound']['ok']:
+        failed = True
+    if 'fileid' in results and not results['fileid']['ok']:
+        failed = True
+    if 'export' in results and not results['export']['ok']:
+        failed = True
+    if 'journal' in results:
+        journal = results['journal']
+        if not all(result['replay_ok'] for result in journal.values()) or journal['group']['records_per_s'] < JOURNAL_MIN_RATE:
+            failed = True
+    if 'crash' in results:
+        crash = results['crash']
+        if crash['lost_drops'] or crash['wrong_points'] or crash['recovery_failures'] or crash['corrupt_preserved'] != crash['corrupt_snapshots']:
+            failed = True
+    if 'shards' in results:
+        shards = results['shards']
+        if (shards['failed_workers'] or shards['double_drops'] or shards['wrong_points'] or shards['photos'] != SHARD_USERS
+                or shards['db_cards'] != shards['photos'] or shards['updates'] != shards['accepted'] or not shards['top_ok']):
+            failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -1,99 +1,1923 @@
 import os
+import sys
 import random
+import hashlib
+import mimetypes
 import logging
+import logging.handlers
+import queue
+import atexit
+import signal
 import json
+import csv
+import ctypes
+import ctypes.util
 import asyncio
+import heapq
+import itertools
+import time
+import zlib
+import sqlite3
+import threading
+import multiprocessing
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from telegram import Update
-from telegram.ext import Application, CommandHandler, ContextTypes, JobQueue
+from functools import wraps
+from telegram import Bot, Update
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from telegram.ext import Application, CommandHandler, ContextTypes
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_LEVEL = "INFO"
+LOG_LEVELS = {"httpx": "WARNING"}
+LOG_JSON = False
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = None
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def setup_logging():
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if LOG_JSON else logging.Formatter(LOG_FORMAT))
+    
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+    for name, level in LOG_LEVELS.items():
+        logging.getLogger(name).setLevel(level)
+    
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
+class Metrics:
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, float('inf'))
+    
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.histograms = {}
+        self.gauges = {}
+    
+    def inc(self, name, value=1):
+        self.counters[name] += value
+    
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+    
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = {'buckets': [0] * len(self.BUCKETS), 'count': 0, 'sum': 0.0, 'max': 0.0}
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+                break
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+        histogram['max'] = max(histogram['max'], seconds)
+    
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+    
+    def snapshot(self):
+        histograms = {}
+        for name, histogram in self.histograms.items():
+            histograms[name] = {
+                'count': histogram['count'],
+                'avg': histogram['sum'] / histogram['count'] if histogram['count'] else 0.0,
+                'max': histogram['max'],
+                'buckets': {('+Inf' if bound == float('inf') else str(bound)): count
+                            for bound, count in zip(self.BUCKETS, histogram['buckets'])}
+            }
+        return {'counters': dict(self.counters), 'gauges': dict(self.gauges), 'histograms': histograms}
+    
+    def dump(self):
+        logger.info("Метрики: %s", json.dumps(self.snapshot(), ensure_ascii=False))
+    
+    async def handle_http(self, reader, writer):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = json.dumps(self.snapshot(), ensure_ascii=False).encode('utf-8')
+            writer.write(
+                b'HTTP/1.1 200 OK\r\nContent-Type: application/json; charset=utf-8\r\n'
+                b'Content-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    
+    async def serve(self, host=METRICS_HOST, port=METRICS_PORT):
+        server = await asyncio.start_server(self.handle_http, host, port)
+        logger.info("Метрики доступны на http://%s:%s/", host, port)
+        return server
+
+metrics = Metrics()
+
+def instrumented(name):
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            metrics.inc(f"{name}.calls")
+            start = time.perf_counter()
+            try:
+                return await handler(update, context)
+            except Exception:
+                metrics.inc(f"{name}.errors")
+                raise
+            finally:
+                metrics.observe(f"{name}.latency", time.perf_counter() - start)
+        return wrapper
+    return decorator
+
 BOT_TOKEN = "TOKEN"
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CARDS_FOLDER = "cards"
 DATA_FILE = "users_data.json"
+STORAGE_BACKEND = "json"
+SQLITE_FILE = "users_data.db"
+FILE_ID_CACHE_FILE = "card_file_ids.json"
+JOURNAL_ENABLED = True
+JOURNAL_FILE = "users_data.journal"
+JOURNAL_GROUP_SIZE = 512
+JOURNAL_GROUP_DELAY = 0
+JOURNAL_CHECKPOINT_BYTES = 4 * 1024 * 1024
 SUPPORTED_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp'}
 COOLDOWN_MINUTES = 30
+COOLDOWN_CLAIM_TIMEOUT = 1.0
+PREPROCESS_CARDS = False
+PREPARED_FOLDER = "cards_prepared"
+PREPARED_MAX_SIDE = 1280
+PREPARED_QUALITY = 85
+PREPARE_WORKERS = None
+CARD_PRELOAD_BYTES = 256 * 1024
+CARD_PRELOAD_TOTAL = 64 * 1024 * 1024
+CONCURRENT_UPDATES = 256
+IO_WORKERS = 16
+NOTIFY_BATCH_SIZE = 25
+NOTIFY_BATCH_INTERVAL = 1.0
+NOTIFY_MISSED_LIMIT_MINUTES = 60
+OUTBOUND_GLOBAL_RATE = 30
+OUTBOUND_GLOBAL_BURST = 1
+OUTBOUND_CHAT_RATE = 1.0
+OUTBOUND_CHAT_BURST = 3
+OUTBOUND_CHAT_BUCKETS = 10000
+OUTBOUND_WORKERS = 8
+OUTBOUND_MAX_RETRIES = 3
+OUTBOUND_BACKOFF = 1.0
+OUTBOUND_DRAIN_SECONDS = 10
+UNSENT_REQUEST_ERRORS = {'ConnectError', 'ConnectTimeout', 'PoolTimeout'}
+PRIORITY_REPLY = 0
+PRIORITY_NOTIFY = 1
+RARITY_TIERS = [
+    (90, 1),
+    (70, 4),
+    (40, 10),
+    (0, 25),
+]
+CARD_WEIGHTS = {}
+PITY_THRESHOLD = 0
+PITY_MIN_POINTS = 70
+DROP_SEED = None
+WATCH_CARDS = True
+CARDS_POLL_SECONDS = 10
+CARDS_RELOAD_DELAY = 1.0
+SAVE_INTERVAL_SECONDS = 5
+SAVE_BATCH_SIZE = 100
+USER_CACHE_SIZE = 10000
+TOP_LIMIT = 10
+EXPORT_FOLDER = "export"
+EXPORT_FORMAT = "csv"
+EXPORT_CHUNK_SIZE = 50000
+EXPORT_MATRIX_CELLS = 4_000_000
+EXPORT_HISTOGRAM_WIDTH = 100
+SHARD_WORKERS = 0
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_URL = ""
+WEBHOOK_SECRET = ""
+
+def parse_cooldown(value):
+    if isinstance(value, str):
+        return datetime.fromisoformat(value).timestamp()
+    return float(value)
+
+class DataCorruptedError(Exception):
+    pass
+
+SNAPSHOT_HEADER = b'{"checksum":"'
+SNAPSHOT_BODY = b'","data":'
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def fsync_dir(path):
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def encode_snapshot(data):
+    payload = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return SNAPSHOT_HEADER + hashlib.sha256(payload).hexdigest().encode('ascii') + SNAPSHOT_BODY + payload + b'}'
+
+def decode_snapshot(raw, path):
+    if raw.startswith(SNAPSHOT_HEADER):
+        checksum_end = len(SNAPSHOT_HEADER) + 64
+        checksum = raw[len(SNAPSHOT_HEADER):checksum_end]
+        payload = raw[checksum_end + len(SNAPSHOT_BODY):-1]
+        if (raw[checksum_end:checksum_end + len(SNAPSHOT_BODY)] != SNAPSHOT_BODY or not raw.endswith(b'}')
+                or hashlib.sha256(payload).hexdigest().encode('ascii') != checksum):
+            raise DataCorruptedError(f"контрольная сумма {path} не совпадает")
+    else:
+        payload = raw
+    try:
+        return json.loads(payload)
+    except ValueError as e:
+        raise DataCorruptedError(f"{path}: {e}") from e
+
+def load_card_file(path, preload_bytes=CARD_PRELOAD_BYTES):
+    stat = os.stat(path)
+    if stat.st_size <= preload_bytes:
+        data = read_file(path)
+        return stat, hashlib.sha256(data).hexdigest(), data
+    
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return stat, digest.hexdigest(), None
+
+def prepare_card_image(source_path, target_folder, max_side=PREPARED_MAX_SIDE, quality=PREPARED_QUALITY):
+    digest = hashlib.sha256()
+    with open(source_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    digest.update(f"{max_side}:{quality}".encode())
+    target_path = os.path.join(target_folder, digest.hexdigest()[:32] + '.jpg')
+    
+    if os.path.exists(target_path):
+        return target_path
+    
+    with Image.open(source_path) as image:
+        if getattr(image, 'is_animated', False):
+            return None
+        
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+        
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        
+        tmp_path = target_path + '.tmp'
+        image.save(tmp_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+        os.replace(tmp_path, target_path)
+    
+    return target_path
+
+class JsonStorage:
+    incremental = False
+    indexed = False
+    lazy = False
+    shared = False
+    
+    def __init__(self, data_path, backup=False):
+        self.data_path = data_path
+        self.backup = backup
+        self.backup_path = f"{data_path}.bak"
+    
+    def load(self):
+        try:
+            return self.read(self.data_path)
+        except DataCorruptedError as e:
+            if not self.backup:
+                raise
+            corrupt_path = f"{self.data_path}.corrupt-{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+            os.replace(self.data_path, corrupt_path)
+            logger.error("Снимок данных повреждён (%s), сохранён как %s, загружаем резервную копию", e, corrupt_path)
+        
+        data = self.read(self.backup_path)
+        if data is None:
+            raise DataCorruptedError(f"{self.data_path} повреждён, резервной копии {self.backup_path} нет")
+        return data
+    
+    def read(self, path):
+        if path == self.data_path and not os.path.exists(path) and self.backup and os.path.exists(self.backup_path):
+            logger.warning("Файл %s не найден, загружаем резервную копию %s", path, self.backup_path)
+            path = self.backup_path
+        if not os.path.exists(path):
+            return None
+        return decode_snapshot(read_file(path), path)
+    
+    def save(self, data):
+        tmp_path = f"{self.data_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(encode_snapshot(data))
+            f.flush()
+            os.fsync(f.fileno())
+        if self.backup and os.path.exists(self.data_path):
+            os.replace(self.data_path, self.backup_path)
+        os.replace(tmp_path, self.data_path)
+        fsync_dir(self.data_path)
+    
+    def load_meta(self):
+        return self.load()
+    
+    def iter_users(self, batch_size=EXPORT_CHUNK_SIZE):
+        data = self.load() or {}
+        user_cards = data.get('user_cards', {})
+        cooldowns = data.get('user_cooldowns', {})
+        vsrakost = data.get('user_vsrakost', {})
+        names = data.get('user_names', {})
+        user_ids = sorted(set(user_cards) | set(cooldowns) | set(vsrakost) | set(names), key=int)
+        for start in range(0, len(user_ids), batch_size):
+            yield [
+                (
+                    int(user_id_str),
+                    names.get(user_id_str),
+                    vsrakost.get(user_id_str),
+                    parse_cooldown(cooldowns[user_id_str]) if cooldowns.get(user_id_str) else None,
+                    user_cards.get(user_id_str, [])
+                )
+                for user_id_str in user_ids[start:start + batch_size]
+            ]
+    
+    def close(self):
+        pass
+
+class SqliteStorage:
+    incremental = True
+    indexed = True
+    lazy = True
+    shared = True
+    backup = False
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            name TEXT,
+            vsrakost INTEGER,
+            cooldown_at REAL,
+            cards TEXT NOT NULL DEFAULT '[]'
+        );
+        CREATE INDEX IF NOT EXISTS users_vsrakost ON users (vsrakost DESC, user_id);
+        CREATE INDEX IF NOT EXISTS users_cooldown_at ON users (cooldown_at) WHERE cooldown_at IS NOT NULL;
+        CREATE TABLE IF NOT EXISTS cards (
+            card_id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS card_points (
+            card TEXT PRIMARY KEY,
+            points INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+    UPSERT_USER = """
+        INSERT INTO users (user_id, name, vsrakost, cooldown_at, cards) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            name = excluded.name,
+            vsrakost = excluded.vsrakost,
+            cooldown_at = excluded.cooldown_at,
+            cards = excluded.cards
+    """
+    CLAIM_COOLDOWN = """
+        INSERT INTO users (user_id, cooldown_at) VALUES (?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET cooldown_at = excluded.cooldown_at
+        WHERE users.cooldown_at IS NULL OR users.cooldown_at <= ?
+    """
+    UPSERT_CARD_POINTS = """
+        INSERT INTO card_points (card, points) VALUES (?, ?)
+        ON CONFLICT (card) DO UPDATE SET points = excluded.points
+    """
+    VSRAKOST_COUNTS = (
+        """
+        CREATE TABLE IF NOT EXISTS vsrakost_counts (
+            vsrakost INTEGER PRIMARY KEY,
+            users INTEGER NOT NULL
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS users_vsrakost_insert AFTER INSERT ON users WHEN new.vsrakost IS NOT NULL BEGIN
+            INSERT INTO vsrakost_counts (vsrakost, users) VALUES (new.vsrakost, 1)
+            ON CONFLICT (vsrakost) DO UPDATE SET users = users + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS users_vsrakost_update AFTER UPDATE OF vsrakost ON users WHEN old.vsrakost IS NOT new.vsrakost BEGIN
+            UPDATE vsrakost_counts SET users = users - 1 WHERE vsrakost = old.vsrakost;
+            DELETE FROM vsrakost_counts WHERE vsrakost = old.vsrakost AND users = 0;
+            INSERT INTO vsrakost_counts (vsrakost, users) SELECT new.vsrakost, 1 WHERE new.vsrakost IS NOT NULL
+            ON CONFLICT (vsrakost) DO UPDATE SET users = users + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS users_vsrakost_delete AFTER DELETE ON users WHEN old.vsrakost IS NOT NULL BEGIN
+            UPDATE vsrakost_counts SET users = users - 1 WHERE vsrakost = old.vsrakost;
+            DELETE FROM vsrakost_counts WHERE vsrakost = old.vsrakost AND users = 0;
+        END
+        """,
+        """
+        INSERT INTO vsrakost_counts (vsrakost, users)
+        SELECT vsrakost, COUNT(*) FROM users WHERE vsrakost IS NOT NULL GROUP BY vsrakost
+        """
+    )
+    
+    def __init__(self, db_path, json_path=None):
+        self.db_path = db_path
+        self.json_path = json_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.busy_timeout = self.conn.execute("PRAGMA busy_timeout").fetchone()[0]
+        self.migrate_cooldowns()
+        self.conn.executescript(self.SCHEMA)
+        self.migrate_vsrakost_counts()
+        self.read_lock = threading.Lock()
+        self.read_conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self.read_conn.execute("PRAGMA query_only=ON")
+        self.migrate_from_json()
+    
+    def migrate_cooldowns(self):
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(users)")}
+        if 'cooldown' not in columns or 'cooldown_at' in columns:
+            return
+        
+        logger.info("Переводим таймеры в %s в числовой формат...", self.db_path)
+        rows = self.conn.execute("SELECT user_id, cooldown FROM users WHERE cooldown IS NOT NULL").fetchall()
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.execute("ALTER TABLE users ADD COLUMN cooldown_at REAL")
+            self.conn.execute("DROP INDEX IF EXISTS users_cooldown")
+            self.conn.executemany(
+                "UPDATE users SET cooldown_at = ?, cooldown = NULL WHERE user_id = ?",
+                ((parse_cooldown(cooldown), user_id) for user_id, cooldown in rows)
+            )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+    
+    def migrate_vsrakost_counts(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            exists = self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'users_vsrakost_update'").fetchone()
+            if not exists:
+                logger.info("Строим счётчики рейтинга в %s...", self.db_path)
+                for statement in self.VSRAKOST_COUNTS:
+                    self.conn.execute(statement)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+    
+    def migrate_from_json(self):
+        if not self.json_path or not os.path.exists(self.json_path):
+            return
+        
+        with self.lock:
+            migrated = self.conn.execute("SELECT value FROM meta WHERE key = 'migrated_from_json'").fetchone()
+        if migrated:
+            return
+        
+        logger.info("Переносим данные из %s в %s...", self.json_path, self.db_path)
+        data = JsonStorage(self.json_path).load()
+        self.save(data, meta={'migrated_from_json': datetime.now().isoformat()})
+        logger.info("Перенесены данные %s пользователей", len(data.get('user_cards', {})))
+    
+    def load(self):
+        with self.read_lock:
+            users = self.read_conn.execute("SELECT user_id, name, vsrakost, cooldown_at, cards FROM users").fetchall()
+            card_points = self.read_conn.execute("SELECT card, points FROM card_points").fetchall()
+            card_names = self.read_conn.execute("SELECT card_id, name FROM cards ORDER BY card_id").fetchall()
+        
+        if not users and not card_points:
+            return None
+        
+        data = {
+            'user_cards': {},
+            'user_cooldowns': {},
+            'user_vsrakost': {},
+            'user_names': {},
+            'card_points': dict(card_points),
+            'card_names': [name for card_id, name in card_names],
+            'journal': self.load_journal_lsns()
+        }
+        for user_id, name, vsrakost, cooldown, cards in users:
+            user_id_str = str(user_id)
+            data['user_cards'][user_id_str] = json.loads(cards)
+            if cooldown is not None:
+                data['user_cooldowns'][user_id_str] = cooldown
+            if vsrakost is not None:
+                data['user_vsrakost'][user_id_str] = vsrakost
+            if name is not None:
+                data['user_names'][user_id_str] = name
+        return data
+    
+    def load_meta(self):
+        with self.read_lock:
+            (has_users,) = self.read_conn.execute("SELECT EXISTS (SELECT 1 FROM users)").fetchone()
+            card_points = self.read_conn.execute("SELECT card, points FROM card_points").fetchall()
+            card_names = self.read_conn.execute("SELECT card_id, name FROM cards ORDER BY card_id").fetchall()
+        
+        if not has_users and not card_points:
+            return None
+        return {
+            'card_points': dict(card_points),
+            'card_names': [name for card_id, name in card_names],
+            'journal': self.load_journal_lsns()
+        }
+    
+    def load_journal_lsns(self):
+        with self.read_lock:
+            rows = self.read_conn.execute("SELECT key, value FROM meta WHERE key LIKE 'journal:%'").fetchall()
+        return {key[len('journal:'):]: int(value) for key, value in rows}
+    
+    def iter_users(self, batch_size=EXPORT_CHUNK_SIZE):
+        last_user_id = -2 ** 63
+        while True:
+            with self.read_lock:
+                rows = self.read_conn.execute(
+                    "SELECT user_id, name, vsrakost, cooldown_at, cards FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                    (last_user_id, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            last_user_id = rows[-1][0]
+            yield [(user_id, name, vsrakost, cooldown, json.loads(cards)) for user_id, name, vsrakost, cooldown, cards in rows]
+    
+    def load_user(self, user_id):
+        with self.read_lock:
+            row = self.read_conn.execute(
+                "SELECT name, vsrakost, cooldown_at, cards FROM users WHERE user_id = ?",
+                (user_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        name, vsrakost, cooldown, cards = row
+        return {'name': name, 'vsrakost': vsrakost, 'cooldown': cooldown, 'cards': json.loads(cards)}
+    
+    def load_cooldowns(self):
+        with self.read_lock:
+            return self.read_conn.execute("SELECT user_id, cooldown_at FROM users WHERE cooldown_at IS NOT NULL").fetchall()
+    
+    @contextmanager
+    def short_write(self, timeout):
+        if not self.lock.acquire(timeout=timeout):
+            raise TimeoutError("база занята сохранением")
+        try:
+            self.conn.execute(f"PRAGMA busy_timeout = {int(timeout * 1000)}")
+            try:
+                yield self.conn
+            finally:
+                self.conn.execute(f"PRAGMA busy_timeout = {self.busy_timeout}")
+        finally:
+            self.lock.release()
+    
+    def claim_cooldown(self, user_id, cooldown, expired_before, timeout=COOLDOWN_CLAIM_TIMEOUT):
+        with self.short_write(timeout):
+            cursor = self.conn.execute(self.CLAIM_COOLDOWN, (user_id, cooldown, expired_before))
+            return cursor.rowcount == 1
+    
+    def release_cooldown(self, user_id, reserved, previous, timeout=COOLDOWN_CLAIM_TIMEOUT):
+        with self.short_write(timeout):
+            self.conn.execute(
+                "UPDATE users SET cooldown_at = ? WHERE user_id = ? AND cooldown_at = ?",
+                (previous, user_id, reserved)
+            )
+    
+    def data_version(self):
+        with self.lock:
+            return self.conn.execute("PRAGMA data_version").fetchone()[0]
+    
+    def clear_cooldowns(self, user_ids):
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany("UPDATE users SET cooldown_at = NULL WHERE user_id = ?", ((user_id,) for user_id in user_ids))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+    
+    def save(self, data, meta=None):
+        meta = dict(meta or {})
+        for journal_name, lsn in data.get('journal', {}).items():
+            meta[f"journal:{journal_name}"] = str(lsn)
+        user_cards = data.get('user_cards', {})
+        cooldowns = data.get('user_cooldowns', {})
+        vsrakost = data.get('user_vsrakost', {})
+        names = data.get('user_names', {})
+        user_ids = set(user_cards) | set(cooldowns) | set(vsrakost) | set(names)
+        
+        rows = [
+            (
+                int(user_id_str),
+                names.get(user_id_str),
+                vsrakost.get(user_id_str),
+                parse_cooldown(cooldowns[user_id_str]) if cooldowns.get(user_id_str) else None,
+                json.dumps(user_cards.get(user_id_str, []), ensure_ascii=False)
+            )
+            for user_id_str in user_ids
+        ]
+        
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany(self.UPSERT_USER, rows)
+                self.conn.executemany(self.UPSERT_CARD_POINTS, data.get('card_points', {}).items())
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO cards (card_id, name) VALUES (?, ?)",
+                    enumerate(data.get('card_names', []))
+                )
+                if meta:
+                    self.conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", meta.items())
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+    
+    def get_top_users(self, limit):
+        with self.read_lock:
+            return self.read_conn.execute(
+                "SELECT user_id, vsrakost FROM users WHERE vsrakost IS NOT NULL "
+                "ORDER BY vsrakost DESC, user_id LIMIT ?",
+                (limit,)
+            ).fetchall()
+    
+    def get_vsrakost_rank(self, points):
+        with self.read_lock:
+            (higher,) = self.read_conn.execute(
+                "SELECT COALESCE(SUM(users), 0) FROM vsrakost_counts WHERE vsrakost > ?",
+                (points,)
+            ).fetchone()
+        return higher + 1
+    
+    def close(self):
+        with self.read_lock:
+            self.read_conn.close()
+        with self.lock:
+            self.conn.close()
+
+class WriteAheadJournal:
+    def __init__(self, path, group_size=JOURNAL_GROUP_SIZE, group_delay=JOURNAL_GROUP_DELAY):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.group_size = group_size
+        self.group_delay = group_delay
+        self.file = None
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.lsn = 0
+        self.durable_lsn = 0
+        self.waiters = []
+        self.event = None
+        self.task = None
+        self.stopping = False
+    
+    @staticmethod
+    def encode(record):
+        payload = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        return b'%08x %s\n' % (zlib.crc32(payload), payload)
+    
+    @staticmethod
+    def decode(line):
+        checksum, _, payload = line.partition(b' ')
+        try:
+            if len(checksum) != 8 or int(checksum, 16) != zlib.crc32(payload):
+                return None
+            return json.loads(payload)
+        except ValueError:
+            return None
+    
+    def recover(self, after_lsn):
+        self.close()
+        records = []
+        last_lsn = after_lsn
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                raw = f.read()
+            
+            offset = 0
+            valid_end = 0
+            torn = False
+            while offset < len(raw):
+                end = raw.find(b'\n', offset)
+                record = self.decode(raw[offset:end]) if end != -1 else None
+                if record is None:
+                    torn = True
+                    break
+                offset = end + 1
+                valid_end = offset
+                lsn = record['lsn']
+                if lsn <= last_lsn:
+                    continue
+                if lsn != last_lsn + 1:
+                    raise DataCorruptedError(f"в журнале {self.path} пропущены записи {last_lsn + 1}..{lsn - 1}")
+                records.append(record)
+                last_lsn = lsn
+            
+            if torn:
+                rest = raw[valid_end:]
+                if any(self.decode(line) for line in rest.split(b'\n')[1:]):
+                    raise DataCorruptedError(f"журнал {self.path} повреждён на позиции {valid_end}")
+                logger.warning("Журнал %s оборван на позиции %s, отброшено %s байт незавершённой записи", self.path, valid_end, len(rest))
+                with open(self.path, 'r+b') as f:
+                    f.truncate(valid_end)
+                    f.flush()
+                    os.fsync(f.fileno())
+        
+        self.lsn = last_lsn
+        self.durable_lsn = last_lsn
+        return records
+    
+    def append(self, record):
+        self.lsn += 1
+        self.buffer.append(self.encode({'lsn': self.lsn, **record}))
+        if self.event and len(self.buffer) >= self.group_size:
+            self.event.set()
+        return self.lsn
+    
+    def write(self, lines):
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'ab')
+            position = self.file.tell()
+            try:
+                self.file.write(b''.join(lines))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except Exception:
+                self.file.truncate(position)
+                raise
+    
+    def commit_sync(self):
+        if self.buffer:
+            lines, self.buffer = self.buffer, []
+            self.write(lines)
+            self.durable_lsn = self.lsn
+    
+    async def commit(self):
+        if self.buffer:
+            lines, self.buffer = self.buffer, []
+            lsn = self.lsn
+            try:
+                with metrics.timer('journal.fsync'):
+                    await asyncio.to_thread(self.write, lines)
+            except Exception as e:
+                self.buffer = lines + self.buffer
+                logger.critical("Ошибка записи журнала %s: %s", self.path, e)
+                for _, future in self.waiters:
+                    if not future.done():
+                        future.set_exception(e)
+                self.waiters = []
+                return
+            self.durable_lsn = lsn
+            metrics.inc('journal.commits')
+            metrics.inc('journal.records', len(lines))
+        
+        waiting = []
+        for lsn, future in self.waiters:
+            if lsn <= self.durable_lsn:
+                if not future.done():
+                    future.set_result(None)
+            else:
+                waiting.append((lsn, future))
+        self.waiters = waiting
+    
+    async def wait(self, lsn):
+        if lsn <= self.durable_lsn:
+            return
+        if self.task is None:
+            self.commit_sync()
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((lsn, future))
+        self.event.set()
+        await future
+    
+    async def run(self):
+        while not self.stopping:
+            await self.event.wait()
+            self.event.clear()
+            if self.group_delay and len(self.buffer) < self.group_size:
+                await asyncio.sleep(self.group_delay)
+            await self.commit()
+    
+    def start(self):
+        self.stopping = False
+        self.event = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+    
+    async def stop(self):
+        if self.task:
+            self.stopping = True
+            self.event.set()
+            await self.task
+            self.task = None
+            self.event = None
+        await self.commit()
+    
+    def checkpoint(self, lsn):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if not os.path.exists(self.path):
+                return
+            
+            with open(self.path, 'rb') as f:
+                lines = f.read().splitlines(keepends=True)
+            kept = []
+            for line in lines:
+                record = self.decode(line.rstrip(b'\n'))
+                if record is None or record['lsn'] > lsn:
+                    kept.append(line)
+            
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(b''.join(kept))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            fsync_dir(self.path)
+        logger.debug("Журнал %s сжат до записи %s: осталось %s из %s", self.path, lsn, len(kept), len(lines))
+    
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+    
+    def close(self):
+        self.commit_sync()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+class VsrakostRanking:
+    def __init__(self, size=1024):
+        self.size = size
+        self.tree = [0] * (size + 1)
+        self.total = 0
+        self.user_points = {}
+        self.score_users = {}
+    
+    def _grow(self, points):
+        size = self.size
+        while size <= points:
+            size *= 2
+        
+        tree = [0] * (size + 1)
+        for score, users in self.score_users.items():
+            tree[score + 1] = len(users)
+        for i in range(1, size + 1):
+            parent = i + (i & -i)
+            if parent <= size:
+                tree[parent] += tree[i]
+        
+        self.size = size
+        self.tree = tree
+    
+    def _add(self, points, delta):
+        i = points + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+    
+    def _count_upto(self, points):
+        i = min(points + 1, self.size)
+        count = 0
+        while i > 0:
+            count += self.tree[i]
+            i -= i & -i
+        return count
+    
+    def _kth_smallest(self, k):
+        pos = 0
+        step = 1 << (self.size.bit_length() - 1)
+        while step:
+            nxt = pos + step
+            if nxt <= self.size and self.tree[nxt] < k:
+                pos = nxt
+                k -= self.tree[nxt]
+            step >>= 1
+        return pos
+    
+    def update(self, user_id, points):
+        old_points = self.user_points.get(user_id)
+        if old_points == points:
+            return
+        
+        if old_points is not None:
+            self._add(old_points, -1)
+            users = self.score_users[old_points]
+            users.discard(user_id)
+            if not users:
+                del self.score_users[old_points]
+            self.total -= 1
+        
+        if points >= self.size:
+            self._grow(points)
+        
+        self._add(points, 1)
+        self.score_users.setdefault(points, set()).add(user_id)
+        self.user_points[user_id] = points
+        self.total += 1
+    
+    def rank(self, user_id):
+        points = self.user_points.get(user_id)
+        if points is None:
+            return None
+        return self.total - self._count_upto(points) + 1
+    
+    def top(self, limit):
+        result = []
+        seen = 0
+        while len(result) < limit and seen < self.total:
+            points = self._kth_smallest(self.total - seen)
+            users = self.score_users[points]
+            for user_id in heapq.nsmallest(limit - len(result), users):
+                result.append((user_id, points))
+            seen += len(users)
+        return result
+
+class NotificationScheduler:
+    def __init__(self, batch_size=NOTIFY_BATCH_SIZE, batch_interval=NOTIFY_BATCH_INTERVAL):
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.heap = []
+        self.due = {}
+        self.wakeup = None
+        self.task = None
+        self.stopping = False
+    
+    def __len__(self):
+        return len(self.due)
+    
+    def schedule(self, user_id, due):
+        self.due[user_id] = due
+        heapq.heappush(self.heap, (due, user_id))
+        if self.wakeup and self.heap[0] == (due, user_id):
+            self.wakeup.set()
+    
+    def cancel(self, user_id):
+        self.due.pop(user_id, None)
+    
+    def pop_due(self, now):
+        batch = []
+        while self.heap and self.heap[0][0] <= now and len(batch) < self.batch_size:
+            due, user_id = heapq.heappop(self.heap)
+            if self.due.get(user_id) == due:
+                del self.due[user_id]
+                batch.append((user_id, due))
+        return batch
+    
+    async def run(self, send):
+        while not self.stopping:
+            now = time.time()
+            batch = self.pop_due(now)
+            metrics.set_gauge('notify.pending', len(self.due))
+            if batch:
+                for user_id, due in batch:
+                    metrics.observe('notify.lag', now - due)
+                started = time.monotonic()
+                results = await asyncio.gather(*(send(user_id, due) for user_id, due in batch), return_exceptions=True)
+                for (user_id, due), result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        metrics.inc('notify.errors')
+                        logger.error("Ошибка при обработке уведомления пользователя %s: %s", user_id, result)
+                await asyncio.sleep(max(0.0, self.batch_interval - (time.monotonic() - started)))
+                continue
+            
+            self.wakeup.clear()
+            timeout = max(0.0, self.heap[0][0] - time.time()) if self.heap else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+    
+    def start(self, send):
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run(send))
+    
+    async def stop(self):
+        if self.task:
+            self.stopping = True
+            self.wakeup.set()
+            await self.task
+            self.task = None
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+    
+    def delay(self, now):
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if not self.rate:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+    
+    def take(self):
+        if self.rate:
+            self.tokens -= 1
+    
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+    
+    def idle(self, now):
+        return now >= self.blocked_until and (not self.rate or now - self.updated >= self.burst / self.rate)
+
+def request_not_sent(error):
+    return type(error.__cause__).__name__ in UNSENT_REQUEST_ERRORS
+
+class OutboundJob:
+    def __init__(self, chat_id, call, priority, coalesce_key, future, resend=True):
+        self.chat_id = chat_id
+        self.call = call
+        self.priority = priority
+        self.coalesce_key = coalesce_key
+        self.future = future
+        self.resend = resend
+        self.sequence = 0
+        self.attempts = 0
+        self.created = time.monotonic()
+
+class OutboundDispatcher:
+    def __init__(self, global_rate=OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE, chat_burst=OUTBOUND_CHAT_BURST,
+                 workers=OUTBOUND_WORKERS, max_retries=OUTBOUND_MAX_RETRIES, backoff=OUTBOUND_BACKOFF, global_burst=OUTBOUND_GLOBAL_BURST):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.workers_count = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.sequence = itertools.count()
+        self.queue = None
+        self.workers = []
+        self.jobs = set()
+        self.coalesced = {}
+    
+    def start(self):
+        self.queue = asyncio.PriorityQueue()
+        self.workers = [asyncio.create_task(self.run_worker()) for _ in range(self.workers_count)]
+    
+    async def stop(self, timeout=OUTBOUND_DRAIN_SECONDS):
+        if self.queue is None:
+            return
+        if self.jobs:
+            await asyncio.wait([job.future for job in self.jobs], timeout=timeout)
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        for job in list(self.jobs):
+            logger.warning("Сообщение в чат %s не отправлено до остановки", job.chat_id)
+            job.future.cancel()
+            self.finish(job)
+        self.workers = []
+        self.queue = None
+    
+    async def send(self, chat_id, call, priority=PRIORITY_REPLY, coalesce_key=None, resend=True):
+        if self.queue is None:
+            return await call()
+        
+        if coalesce_key is not None:
+            future = self.coalesced.get(coalesce_key)
+            if future is not None and not future.done():
+                metrics.inc('outbound.coalesced')
+                return await asyncio.shield(future)
+        
+        job = OutboundJob(chat_id, call, priority, coalesce_key, asyncio.get_running_loop().create_future(), resend)
+        job.sequence = next(self.sequence)
+        self.jobs.add(job)
+        if coalesce_key is not None:
+            self.coalesced[coalesce_key] = job.future
+        self.enqueue(job)
+        metrics.set_gauge('outbound.depth', len(self.jobs))
+        return await asyncio.shield(job.future)
+    
+    def enqueue(self, job):
+        if self.queue is not None:
+            self.queue.put_nowait((job.priority, job.sequence, job))
+    
+    def defer(self, job, delay):
+        metrics.inc('outbound.deferred')
+        asyncio.get_running_loop().call_later(delay, self.enqueue, job)
+    
+    def finish(self, job, result=None, error=None):
+        self.jobs.discard(job)
+        if job.coalesce_key is not None and self.coalesced.get(job.coalesce_key) is job.future:
+            del self.coalesced[job.coalesce_key]
+        if not job.future.done():
+            if error is not None:
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(result)
+        metrics.set_gauge('outbound.depth', len(self.jobs))
+    
+    def get_chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= OUTBOUND_CHAT_BUCKETS:
+                now = time.monotonic()
+                for idle_chat_id in [key for key, value in self.chat_buckets.items() if value.idle(now)]:
+                    del self.chat_buckets[idle_chat_id]
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+    
+    async def acquire(self, job):
+        chat_bucket = self.get_chat_bucket(job.chat_id)
+        while True:
+            now = time.monotonic()
+            chat_delay = chat_bucket.delay(now)
+            if chat_delay:
+                self.defer(job, chat_delay)
+                return None
+            global_delay = self.global_bucket.delay(now)
+            if not global_delay:
+                self.global_bucket.take()
+                chat_bucket.take()
+                return chat_bucket
+            await asyncio.sleep(global_delay)
+    
+    async def run_worker(self):
+        while True:
+            priority, sequence, job = await self.queue.get()
+            if job.future.done():
+                self.finish(job)
+                continue
+            
+            chat_bucket = await self.acquire(job)
+            if chat_bucket is None:
+                continue
+            
+            try:
+                result = await job.call()
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                metrics.inc('outbound.retry_after')
+                logger.warning("Telegram просит подождать %s с (чат %s)", retry_after, job.chat_id)
+                self.global_bucket.block(retry_after)
+                chat_bucket.block(retry_after)
+                self.defer(job, retry_after)
+            except BadRequest as e:
+                self.finish(job, error=e)
+            except NetworkError as e:
+                job.attempts += 1
+                if job.attempts > self.max_retries:
+                    self.finish(job, error=e)
+                elif not job.resend and not request_not_sent(e):
+                    metrics.inc('outbound.ambiguous')
+                    self.finish(job, error=e)
+                else:
+                    metrics.inc('outbound.retries')
+                    self.defer(job, self.backoff * 2 ** (job.attempts - 1))
+            except Exception as e:
+                self.finish(job, error=e)
+            else:
+                metrics.observe('outbound.latency', time.monotonic() - job.created)
+                self.finish(job, result)
+
+class AliasTable:
+    def __init__(self, items, weights):
+        self.items = list(items)
+        self.prob = []
+        self.alias = []
+        
+        total = sum(weights)
+        if not self.items or total <= 0:
+            self.items = []
+            return
+        
+        n = len(self.items)
+        scaled = [weight * n / total for weight in weights]
+        prob = [1.0] * n
+        alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            prob[less] = scaled[less]
+            alias[less] = more
+            scaled[more] = scaled[more] + scaled[less] - 1.0
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+        
+        self.prob = prob
+        self.alias = alias
+    
+    def __len__(self):
+        return len(self.items)
+    
+    def sample_index(self, rng):
+        i = rng.randrange(len(self.items))
+        if rng.random() < self.prob[i]:
+            return i
+        return self.alias[i]
+    
+    def sample(self, rng):
+        return self.items[self.sample_index(rng)]
+
+class DropEngine:
+    def __init__(self, rng=None, pity_threshold=PITY_THRESHOLD):
+        self.rng = rng or random.Random(DROP_SEED)
+        self.pity_threshold = pity_threshold
+        self.table = AliasTable([], [])
+        self.rare_table = AliasTable([], [])
+        self.rare_cards = frozenset()
+        self.pity = {}
+    
+    def build(self, weights, rare_cards=()):
+        cards = list(weights)
+        rare = [card for card in cards if card in rare_cards]
+        self.table = AliasTable(cards, [weights[card] for card in cards])
+        self.rare_table = AliasTable(rare, [weights[card] for card in rare])
+        self.rare_cards = frozenset(rare)
+    
+    def draw(self, user_id=None):
+        if not self.table:
+            return None
+        
+        if user_id is None or not self.pity_threshold:
+            return self.table.sample(self.rng)
+        
+        misses = self.pity.get(user_id, 0)
+        if misses + 1 >= self.pity_threshold and self.rare_table:
+            card = self.rare_table.sample(self.rng)
+        else:
+            card = self.table.sample(self.rng)
+        
+        if card in self.rare_cards:
+            self.pity.pop(user_id, None)
+        else:
+            self.pity[user_id] = misses + 1
+        return card
+
+class CardRecord:
+    __slots__ = ('card_id', 'name', 'path', 'size', 'mtime_ns', 'digest', 'mime', 'points', 'file_id', 'data')
+    
+    def __init__(self, card_id, name, path, size, mtime_ns, digest, mime, points, file_id=None, data=None):
+        self.card_id = card_id
+        self.name = name
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.digest = digest
+        self.mime = mime
+        self.points = points
+        self.file_id = file_id
+        self.data = data
+
+class CardsWatcher:
+    IN_ATTRIB = 0x004
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    
+    def __init__(self, path, on_change, poll_interval=CARDS_POLL_SECONDS, delay=CARDS_RELOAD_DELAY):
+        self.path = path
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self.delay = delay
+        self.fd = None
+        self.task = None
+        self.pending = None
+        self.changed = False
+    
+    def open_inotify(self):
+        if not sys.platform.startswith('linux'):
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return None
+            if libc.inotify_add_watch(fd, os.fsencode(self.path), self.WATCH_MASK) < 0:
+                os.close(fd)
+                return None
+            return fd
+        except (OSError, AttributeError):
+            return None
+    
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self.fd = self.open_inotify()
+        if self.fd is not None:
+            loop.add_reader(self.fd, self.on_readable)
+            logger.info("Слежение за папкой карт через inotify: %s", self.path)
+        else:
+            self.task = asyncio.create_task(self.poll())
+            logger.info("Слежение за папкой карт опросом раз в %s сек: %s", self.poll_interval, self.path)
+    
+    def on_readable(self):
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        self.changed = True
+        if self.pending is None or self.pending.done():
+            self.pending = asyncio.create_task(self.reload_later())
+    
+    async def reload_later(self):
+        while self.changed:
+            await asyncio.sleep(self.delay)
+            self.changed = False
+            await self.run_change()
+    
+    async def poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            await self.run_change()
+    
+    async def run_change(self):
+        try:
+            await self.on_change()
+        except Exception as e:
+            logger.error("Ошибка при обновлении карт: %s", e)
+    
+    async def stop(self):
+        if self.fd is not None:
+            asyncio.get_running_loop().remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+        for task in (self.task, self.pending):
+            if task and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.task = None
+        self.pending = None
+
+def shard_for_user(user_id, shard_count):
+    return user_id % shard_count
+
+def update_user_id(update_data):
+    for value in update_data.values():
+        if isinstance(value, dict):
+            if 'from' in value:
+                return value['from']['id']
+            if 'chat' in value:
+                return value['chat']['id']
+    return 0
+
+def cooldown_due(cooldown):
+    return cooldown + COOLDOWN_MINUTES * 60
+
+class CollectionStats:
+    def __init__(self, card_names, card_points, histogram_width=EXPORT_HISTOGRAM_WIDTH):
+        self.card_names = list(card_names)
+        self.card_ids = {card_name: card_id for card_id, card_name in enumerate(self.card_names)}
+        self.card_points = card_points
+        self.histogram_width = histogram_width
+        self.users = 0
+        self.collectors = 0
+        self.total_vsrakost = 0
+        self.owners = [0] * len(self.card_names)
+        self.copies = [0] * len(self.card_names)
+        self.histogram = []
+    
+    def card_name(self, card_id):
+        return self.card_names[card_id] if card_id < len(self.card_names) else f"#{card_id}"
+    
+    def card_counts(self, cards):
+        if not cards or not isinstance(cards[0], str):
+            return cards
+        counts = [0] * len(self.card_names)
+        for card_name in cards:
+            card_id = self.card_ids.get(card_name)
+            if card_id is None:
+                card_id = self.card_ids[card_name] = len(self.card_names)
+                self.card_names.append(card_name)
+                counts.append(0)
+            counts[card_id] += 1
+        return counts
+    
+    def add_histogram(self, bins):
+        if len(bins) > len(self.histogram):
+            self.histogram.extend([0] * (len(bins) - len(self.histogram)))
+        for i, users in enumerate(bins):
+            self.histogram[i] += users
+    
+    def add_batch(self, counts_list, scores):
+        width = max(len(self.card_names), max(map(len, counts_list), default=0))
+        if width > len(self.copies):
+            self.owners.extend([0] * (width - len(self.owners)))
+            self.copies.extend([0] * (width - len(self.copies)))
+        self.users += len(counts_list)
+        
+        if np is not None:
+            rows_per_matrix = max(1, EXPORT_MATRIX_CELLS // max(width, 1))
+            for start in range(0, len(counts_list), rows_per_matrix):
+                part = counts_list[start:start + rows_per_matrix]
+                matrix = np.zeros((len(part), width), dtype=np.uint32)
+                for row, counts in enumerate(part):
+                    if counts:
+                        matrix[row, :len(counts)] = counts
+                copies = matrix.sum(axis=0, dtype=np.int64)
+                owners = np.count_nonzero(matrix, axis=0)
+                for card_id in np.flatnonzero(copies):
+                    self.copies[card_id] += int(copies[card_id])
+                    self.owners[card_id] += int(owners[card_id])
+                self.collectors += int(np.count_nonzero(matrix.any(axis=1)))
+            
+            score_array = np.asarray(scores, dtype=np.int64)
+            self.total_vsrakost += int(score_array.sum())
+            self.add_histogram(np.bincount(np.maximum(score_array, 0) // self.histogram_width).tolist())
+            return
+        
+        for counts in counts_list:
+            collected = False
+            for card_id, count in enumerate(counts):
+                if count:
+                    self.owners[card_id] += 1
+                    self.copies[card_id] += count
+                    collected = True
+            self.collectors += collected
+        
+        bins = []
+        for score in scores:
+            bin_index = max(score, 0) // self.histogram_width
+            if bin_index >= len(bins):
+                bins.extend([0] * (bin_index + 1 - len(bins)))
+            bins[bin_index] += 1
+        self.total_vsrakost += sum(scores)
+        self.add_histogram(bins)
+    
+    def score_percentile(self, fraction):
+        threshold = self.users * fraction
+        seen = 0
+        for i, users in enumerate(self.histogram):
+            seen += users
+            if seen >= threshold:
+                return i * self.histogram_width
+        return 0
+    
+    def summary(self):
+        total_copies = sum(self.copies)
+        total_owned = sum(self.owners)
+        cards = []
+        for card_id, copies in enumerate(self.copies):
+            card_name = self.card_name(card_id)
+            points = self.card_points.get(card_name, 0)
+            owners = self.owners[card_id]
+            cards.append({
+                'card': card_name,
+                'points': points,
+                'owners': owners,
+                'copies': copies,
+                'duplicate_rate': (copies - owners) / copies if copies else 0.0,
+                'vsrakost': copies * points,
+                'contribution': copies * points / self.total_vsrakost if self.total_vsrakost else 0.0
+            })
+        cards.sort(key=lambda card: (-card['vsrakost'], card['card']))
+        
+        return {
+            'users': self.users,
+            'collectors': self.collectors,
+            'total_cards': total_copies,
+            'total_vsrakost': self.total_vsrakost,
+            'duplicate_rate': (total_copies - total_owned) / total_copies if total_copies else 0.0,
+            'score_percentiles': {name: self.score_percentile(fraction) for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))},
+            'score_histogram': [
+                {'from': i * self.histogram_width, 'to': (i + 1) * self.histogram_width - 1, 'users': users}
+                for i, users in enumerate(self.histogram) if users
+            ],
+            'cards': cards
+        }
+
+def write_export_chunk(path_prefix, columns, rows, file_format=EXPORT_FORMAT):
+    if file_format == "parquet":
+        path = path_prefix + '.parquet'
+        table = pyarrow.table({column: [row[i] for row in rows] for i, column in enumerate(columns)})
+        pyarrow.parquet.write_table(table, path)
+        return path
+    
+    path = path_prefix + '.csv'
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerows(rows)
+    return path
+
+def export_collections(storage, out_dir, file_format=EXPORT_FORMAT, chunk_size=EXPORT_CHUNK_SIZE):
+    if file_format == "parquet" and pyarrow is None:
+        logger.warning("pyarrow не установлен, экспортируем в CSV")
+        file_format = "csv"
+    os.makedirs(out_dir, exist_ok=True)
+    
+    meta = storage.load_meta() or {}
+    stats = CollectionStats(meta.get('card_names', []), meta.get('card_points', {}))
+    del meta
+    
+    logger.info("Экспортируем коллекции в %s (%s)...", out_dir, file_format)
+    for index, batch in enumerate(storage.iter_users(chunk_size)):
+        counts_list = [stats.card_counts(cards) for user_id, name, vsrakost, cooldown, cards in batch]
+        scores = [vsrakost or 0 for user_id, name, vsrakost, cooldown, cards in batch]
+        stats.add_batch(counts_list, scores)
+        card_names = [stats.card_name(card_id) for card_id in range(len(stats.copies))]
+        
+        write_export_chunk(
+            os.path.join(out_dir, f"users-{index:05d}"),
+            ('user_id', 'name', 'vsrakost', 'cards', 'distinct_cards', 'cooldown_at'),
+            [
+                (user_id, name or '', score, sum(counts), sum(1 for count in counts if count), cooldown)
+                for (user_id, name, vsrakost, cooldown, cards), counts, score in zip(batch, counts_list, scores)
+            ],
+            file_format
+        )
+        write_export_chunk(
+            os.path.join(out_dir, f"user_cards-{index:05d}"),
+            ('user_id', 'card', 'count'),
+            [
+                (record[0], card_names[card_id], count)
+                for record, counts in zip(batch, counts_list)
+                for card_id, count in enumerate(counts) if count
+            ],
+            file_format
+        )
+        logger.info("Обработано пользователей: %s", stats.users)
+    
+    summary = stats.summary()
+    write_export_chunk(
+        os.path.join(out_dir, "cards"),
+        ('card', 'points', 'owners', 'copies', 'duplicate_rate', 'vsrakost', 'contribution'),
+        [tuple(card.values()) for card in summary['cards']],
+        file_format
+    )
+    with open(os.path.join(out_dir, "summary.json"), 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    
+    logger.info("Пользователей: %s, с картами: %s, карт: %s, VSRAKOSTI: %s",
+                summary['users'], summary['collectors'], summary['total_cards'], summary['total_vsrakost'])
+    logger.info("Доля дубликатов: %.1f%%, очки p50/p90/p99: %s/%s/%s", summary['duplicate_rate'] * 100,
+                *summary['score_percentiles'].values())
+    for card in summary['cards'][:5]:
+        logger.info("   %s: владельцев %s, копий %s, вклад %.1f%%", card['card'], card['owners'], card['copies'], card['contribution'] * 100)
+    return summary
+
+def create_storage(base_dir=None):
+    base_dir = base_dir or BASE_DIR
+    json_path = os.path.join(base_dir, DATA_FILE)
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStorage(os.path.join(base_dir, SQLITE_FILE), json_path)
+    return JsonStorage(json_path, backup=True)
 
 class CardBot:
-    def __init__(self):
+    def __init__(self, storage=None, base_dir=None, shard=None):
+        self.base_dir = base_dir or BASE_DIR
+        self.shard = shard
+        self.cards_path = os.path.join(self.base_dir, CARDS_FOLDER)
         self.cards_list = []
+        self.card_stats = {}
+        self.card_index = {}
+        self.cards_dirty = False
+        self.cards_watcher = None
         self.user_cards = {}
+        self.user_card_totals = {}
+        self.card_ids = {}
+        self.card_names = []
         self.user_cooldowns = {}
-        self.user_notifications = {}
+        self.notifier = NotificationScheduler()
+        self.drop_engine = DropEngine()
         self.user_vsrakost = {}
         self.user_names = {}
         self.card_points = {}
+        self.dirty_users = set()
+        self.saving_users = set()
+        self.snapshot_base = None
+        self.loaded_users = OrderedDict()
+        self.save_event = None
+        self.save_task = None
+        self.saver_stopping = False
+        self.storage = storage or create_storage(self.base_dir)
+        self.journal = None
+        if JOURNAL_ENABLED:
+            journal_file = f"{JOURNAL_FILE}.{shard[0]}" if shard else JOURNAL_FILE
+            self.journal = WriteAheadJournal(os.path.join(self.base_dir, journal_file))
+        self.snapshot_lsn = 0
+        self.backup_lsn = 0
+        self.ranking = None
+        self.top_version = 0
+        self.top_cache = None
+        self.card_file_ids = {}
+        self.prepared_cards = {}
+        self.pending_drops = {}
+        self.outbound = OutboundDispatcher(global_rate=OUTBOUND_GLOBAL_RATE / shard[1] if shard else OUTBOUND_GLOBAL_RATE)
+        self.file_id_cache = JsonStorage(os.path.join(self.base_dir, FILE_ID_CACHE_FILE))
         self.load_cards()
+        self.load_file_id_cache()
         self.load_user_data()
+        self.index_cards()
+        self.rebuild_ranking()
+        self.rebuild_notifications()
+        self.rebuild_drop_table()
+    
+    def scan_cards(self):
+        cards = {}
+        skipped = []
+        with os.scandir(self.cards_path) as entries:
+            for entry in entries:
+                file_ext = os.path.splitext(entry.name)[1].lower()
+                if file_ext in SUPPORTED_EXTENSIONS and entry.is_file():
+                    stat = entry.stat()
+                    cards[entry.name] = (stat.st_mtime_ns, stat.st_size)
+                else:
+                    skipped.append(entry.name)
+        return cards, skipped
+    
+    def apply_cards(self, cards):
+        for card_name in cards:
+            self.intern_card(card_name)
+        self.card_stats = cards
+        self.cards_list = list(cards)
     
     def load_cards(self):
         try:
-            current_dir = os.path.dirname(os.path.abspath(__file__))
-            cards_path = os.path.join(current_dir, CARDS_FOLDER)
+            cards_path = self.cards_path
             
-            print(f"Ищем карты в папке: {cards_path}")
+            logger.info("Ищем карты в папке: %s", cards_path)
             
             if not os.path.exists(cards_path):
                 os.makedirs(cards_path)
-                print(f"Создана папка: {cards_path}")
-                print("Добавьте картинки в эту папку и перезапустите бота")
+                logger.warning("Создана папка: %s", cards_path)
+                logger.warning("Добавьте картинки в эту папку, бот подхватит их автоматически")
                 return
             
-            self.cards_list = []
-            files = os.listdir(cards_path)
-            print(f"Файлов в папке: {len(files)}")
+            cards, skipped = self.scan_cards()
+            logger.info("Файлов в папке: %s", len(cards) + len(skipped))
             
-            for filename in files:
-                file_path = os.path.join(cards_path, filename)
-                file_ext = os.path.splitext(filename)[1].lower()
-                
-                if os.path.isfile(file_path) and file_ext in SUPPORTED_EXTENSIONS:
-                    self.cards_list.append(filename)
-                    print(f"Добавлена карта: {filename}")
-                else:
-                    print(f"Пропущен: {filename}")
+            for filename in cards:
+                logger.debug("Добавлена карта: %s", filename)
+            for filename in skipped:
+                logger.debug("Пропущен: %s", filename)
             
-            print(f"Итог: загружено {len(self.cards_list)} карт")
+            self.apply_cards(cards)
+            logger.info("Итог: загружено %s карт", len(self.cards_list))
             
+            if PREPROCESS_CARDS:
+                self.prepare_cards()
+            
+        except Exception as e:
+            logger.error("Ошибка при загрузке карт: %s", e)
+    
+    async def reload_cards(self):
+        try:
+            cards, skipped = await asyncio.to_thread(self.scan_cards)
         except Exception as e:
-            print(f"Ошибка при загрузке карт: {e}")
-            logger.error(f"Ошибка при загрузке карт: {e}")
+            logger.error("Ошибка при обновлении карт: %s", e)
+            return
+        
+        if cards == self.card_stats:
+            return
+        
+        added = [card for card in cards if card not in self.card_stats]
+        removed = [card for card in self.card_stats if card not in cards]
+        changed = [card for card in cards if card in self.card_stats and cards[card] != self.card_stats[card]]
+        
+        new_points = [card for card in added if card not in self.card_points]
+        for card in new_points:
+            self.card_points[card] = random.randint(1, 100)
+        
+        if PREPROCESS_CARDS and (added or changed):
+            await asyncio.to_thread(self.prepare_cards, list(cards))
+        
+        for card in cards:
+            self.intern_card(card)
+        index = await asyncio.to_thread(self.build_card_index, list(cards))
+        
+        self.apply_cards(cards)
+        self.card_index = index
+        self.rebuild_drop_table()
+        
+        if new_points:
+            self.cards_dirty = True
+            if self.save_event:
+                self.save_event.set()
+        
+        logger.info("Карты обновлены: добавлено %s, удалено %s, изменено %s, всего %s", len(added), len(removed), len(changed), len(self.cards_list))
+    
+    def start_watcher(self):
+        if not WATCH_CARDS or self.shard or not os.path.isdir(self.cards_path):
+            return
+        self.cards_watcher = CardsWatcher(self.cards_path, self.reload_cards)
+        self.cards_watcher.start()
+    
+    async def stop_watcher(self):
+        if self.cards_watcher:
+            await self.cards_watcher.stop()
+            self.cards_watcher = None
+    
+    def prepare_cards(self, cards=None):
+        if Image is None:
+            logger.warning("Pillow не установлен, карты отправляются без подготовки")
+            return
+        
+        target_folder = os.path.join(self.base_dir, PREPARED_FOLDER)
+        os.makedirs(target_folder, exist_ok=True)
+        
+        cards = list(cards or self.cards_list)
+        source_paths = [os.path.join(self.cards_path, card) for card in cards]
+        
+        logger.info("Подготавливаем %s карт в папке %s...", len(cards), target_folder)
+        prepared = {}
+        with ProcessPoolExecutor(max_workers=PREPARE_WORKERS) as executor:
+            futures = [executor.submit(prepare_card_image, path, target_folder) for path in source_paths]
+            for card, future in zip(cards, futures):
+                try:
+                    target_path = future.result()
+                except Exception as e:
+                    logger.warning("Не удалось подготовить карту %s: %s", card, e)
+                    continue
+                if target_path:
+                    prepared[card] = target_path
+        
+        self.prepared_cards = prepared
+        logger.info("Подготовлено карт: %s из %s", len(prepared), len(cards))
+    
+    def intern_card(self, card_name):
+        card_id = self.card_ids.get(card_name)
+        if card_id is None:
+            card_id = len(self.card_names)
+            self.card_ids[card_name] = card_id
+            self.card_names.append(card_name)
+        return card_id
+    
+    def load_card_names(self, card_names):
+        self.card_ids = {}
+        self.card_names = []
+        for card_name in card_names:
+            self.intern_card(card_name)
+        for card_name in self.cards_list:
+            self.intern_card(card_name)
+    
+    def parse_user_cards(self, cards):
+        if not cards or not isinstance(cards[0], str):
+            return array('I', cards), False
+        
+        counts = array('I')
+        for card_name in cards:
+            card_id = self.intern_card(card_name)
+            if card_id >= len(counts):
+                counts.extend([0] * (card_id + 1 - len(counts)))
+            counts[card_id] += 1
+        return counts, True
+    
+    def load_user_cards(self, user_cards_data):
+        self.user_cards = {}
+        self.user_card_totals = {}
+        migrated = 0
+        for user_id_str, cards in user_cards_data.items():
+            user_id = int(user_id_str)
+            counts, converted = self.parse_user_cards(cards)
+            migrated += converted
+            self.user_cards[user_id] = counts
+            self.user_card_totals[user_id] = sum(counts)
+        
+        if migrated:
+            logger.info("Коллекции %s пользователей переведены в компактный формат", migrated)
+            self.dirty_users.update(self.user_cards)
+    
+    def owns(self, user_id):
+        return self.shard is None or shard_for_user(user_id, self.shard[1]) == self.shard[0]
+    
+    def ensure_user(self, user_id):
+        if not self.storage.lazy:
+            return
+        if user_id in self.loaded_users:
+            self.loaded_users.move_to_end(user_id)
+            return
+        
+        record = self.storage.load_user(user_id)
+        if record:
+            counts, converted = self.parse_user_cards(record['cards'])
+        
+        self.loaded_users[user_id] = True
+        if record:
+            self.user_cards[user_id] = counts
+            self.user_card_totals[user_id] = sum(counts)
+            if record['cooldown'] is not None:
+                self.user_cooldowns[user_id] = record['cooldown']
+            if record['vsrakost'] is not None:
+                self.user_vsrakost[user_id] = record['vsrakost']
+            if record['name'] is not None:
+                self.user_names[user_id] = record['name']
+            if converted:
+                self.mark_dirty(user_id)
+        
+        self.evict_users()
+    
+    def evict_users(self):
+        for _ in range(len(self.loaded_users)):
+            if len(self.loaded_users) <= USER_CACHE_SIZE:
+                return
+            user_id, _ = self.loaded_users.popitem(last=False)
+            if user_id in self.dirty_users or user_id in self.saving_users or user_id in self.pending_drops:
+                self.loaded_users[user_id] = True
+                continue
+            for user_data in (self.user_cards, self.user_card_totals, self.user_cooldowns, self.user_vsrakost, self.user_names):
+                user_data.pop(user_id, None)
     
     def load_user_data(self):
         try:
-            current_dir = os.path.dirname(os.path.abspath(__file__))
-            data_path = os.path.join(current_dir, DATA_FILE)
+            if self.storage.lazy:
+                data = self.storage.load_meta()
+            else:
+                data = self.storage.load()
             
-            if os.path.exists(data_path):
-                with open(data_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                
-                print(f"Загружаем данные пользователей...")
+            if data is not None:
+                logger.info("Загружаем данные пользователей...")
                 
-                user_cards_data = data.get('user_cards', {})
-                self.user_cards = {}
-                for user_id_str, cards_list in user_cards_data.items():
-                    user_id = int(user_id_str)
-                    self.user_cards[user_id] = cards_list
+                self.load_card_names(data.get('card_names', []))
+                self.load_user_cards(data.get('user_cards', {}))
                 
                 cooldowns_data = data.get('user_cooldowns', {})
                 self.user_cooldowns = {}
                 for user_id_str, cooldown_str in cooldowns_data.items():
                     user_id = int(user_id_str)
                     if cooldown_str:
-                        self.user_cooldowns[user_id] = datetime.fromisoformat(cooldown_str)
+                        self.user_cooldowns[user_id] = parse_cooldown(cooldown_str)
                 
                 vsrakost_data = data.get('user_vsrakost', {})
                 self.user_vsrakost = {}
                 for user_id_str, vsrakost_points in vsrakost_data.items():
                     user_id = int(user_id_str)
                     self.user_vsrakost[user_id] = vsrakost_points
-                    print(f"Пользователь {user_id}: {vsrakost_points} очков VSRAKOSTI")
                 
                 names_data = data.get('user_names', {})
                 self.user_names = {}
@@ -104,189 +1928,534 @@ class CardBot:
                 card_points_data = data.get('card_points', {})
                 if card_points_data:
                     self.card_points = card_points_data
-                    print(f"Загружены очки для {len(self.card_points)} карт")
+                    logger.info("Загружены очки для %s карт", len(self.card_points))
                 else:
-                    print("Инициализируем очки для карт...")
+                    logger.info("Инициализируем очки для карт...")
                     for card in self.cards_list:
                         if card not in self.card_points:
                             self.card_points[card] = random.randint(1, 100)
-                    print(f"Инициализированы очки для {len(self.card_points)} карт")
-                    self.save_user_data()
+                    logger.info("Инициализированы очки для %s карт", len(self.card_points))
+                    self.cards_dirty = True
                 
                 cards_without_points = [card for card in self.cards_list if card not in self.card_points]
                 if cards_without_points:
-                    print(f"Назначаем очки для {len(cards_without_points)} новых карт...")
+                    logger.info("Назначаем очки для %s новых карт...", len(cards_without_points))
                     for card in cards_without_points:
                         self.card_points[card] = random.randint(1, 100)
-                    self.save_user_data()
+                    self.cards_dirty = True
                 
-                print(f"Загружены данные {len(self.user_cards)} пользователей")
-                print(f"Всего карт у пользователей: {sum(len(cards) for cards in self.user_cards.values())}")
-                print(f"Всего карт с очками: {len(self.card_points)}")
+                if not self.storage.lazy:
+                    logger.info("Загружены данные %s пользователей", len(self.user_cards))
+                logger.info("Всего карт с очками: %s", len(self.card_points))
                 
             else:
-                print("Файл данных не найден, создадим новый при сохранении")
+                logger.warning("Файл данных не найден, создадим новый при сохранении")
                 self.user_cards = {}
+                self.user_card_totals = {}
                 self.user_cooldowns = {}
                 self.user_vsrakost = {}
                 self.user_names = {}
-                print("Инициализируем очки для всех карт...")
+                logger.info("Инициализируем очки для всех карт...")
                 for card in self.cards_list:
                     self.card_points[card] = random.randint(1, 100)
-                print(f"Инициализированы очки для {len(self.card_points)} карт")
-                self.save_user_data()
-                
+                logger.info("Инициализированы очки для %s карт", len(self.card_points))
+                self.cards_dirty = True
+            
+            self.replay_journal(data)
+            
         except Exception as e:
-            print(f"Ошибка при загрузке данных пользователей: {e}")
-            self.user_cards = {}
-            self.user_cooldowns = {}
-            self.user_vsrakost = {}
-            self.user_names = {}
-            for card in self.cards_list:
-                self.card_points[card] = random.randint(1, 100)
-            self.save_user_data()
+            logger.critical("Ошибка при загрузке данных пользователей: %s", e)
+            logger.critical("Данные не сброшены: восстановите снимок или журнал в %s и перезапустите бота", self.base_dir)
+            raise
+    
+    def replay_journal(self, data):
+        if not self.journal:
+            return
+        
+        self.snapshot_lsn = (data or {}).get('journal', {}).get(self.journal.name, 0)
+        self.backup_lsn = 0
+        records = self.journal.recover(self.snapshot_lsn)
+        if not records:
+            return
+        
+        logger.info("Восстанавливаем %s событий из журнала %s после снимка %s", len(records), self.journal.path, self.snapshot_lsn)
+        for record in records:
+            user_id = record['u']
+            if record['t'] == 'drop':
+                card_name = record['c']
+                if self.card_points.get(card_name) != record['p']:
+                    self.card_points[card_name] = record['p']
+                    self.cards_dirty = True
+                self.apply_drop(user_id, card_name, record['p'])
+                if record['at'] is not None:
+                    self.user_cooldowns[user_id] = record['at']
+            elif record['t'] == 'name':
+                self.ensure_user(user_id)
+                self.user_names[user_id] = record['n']
+                self.mark_dirty(user_id)
+        
+        self.save_user_data()
+        logger.info("Журнал применён, данные восстановлены до записи %s", self.journal.lsn)
+    
+    def rebuild_ranking(self):
+        self.invalidate_top()
+        if self.storage.indexed:
+            self.ranking = None
+            return
+        
+        self.ranking = VsrakostRanking()
+        for user_id, points in self.user_vsrakost.items():
+            self.ranking.update(user_id, points)
+    
+    def snapshot_user_data(self, user_ids=None):
+        if user_ids is None:
+            user_ids = set(self.user_cards) | set(self.user_cooldowns) | set(self.user_vsrakost) | set(self.user_names)
+        if self.shard:
+            user_ids = [user_id for user_id in user_ids if self.owns(user_id)]
+        
+        user_cards_data = {}
+        cooldowns_data = {}
+        vsrakost_data = {}
+        names_data = {}
+        for user_id in user_ids:
+            user_id_str = str(user_id)
+            if user_id in self.user_cards:
+                user_cards_data[user_id_str] = list(self.user_cards[user_id])
+            if user_id in self.user_cooldowns:
+                cooldowns_data[user_id_str] = self.user_cooldowns[user_id]
+            if user_id in self.user_vsrakost:
+                vsrakost_data[user_id_str] = self.user_vsrakost[user_id]
+            if user_id in self.user_names:
+                names_data[user_id_str] = self.user_names[user_id]
+        
+        card_points_data = self.card_points.copy()
+        
+        data = {
+            'user_cards': user_cards_data,
+            'user_cooldowns': cooldowns_data,
+            'user_vsrakost': vsrakost_data,
+            'user_names': names_data,
+            'card_points': card_points_data,
+            'card_names': list(self.card_names)
+        }
+        if self.journal:
+            data['journal'] = {self.journal.name: self.journal.lsn}
+        return data
+    
+    def save_snapshot_changes(self, user_ids, changes):
+        data = self.snapshot_base
+        for key in ('user_cards', 'user_cooldowns', 'user_vsrakost', 'user_names'):
+            saved = data[key]
+            changed = changes[key]
+            for user_id in user_ids:
+                user_id_str = str(user_id)
+                if user_id_str in changed:
+                    saved[user_id_str] = changed[user_id_str]
+                else:
+                    saved.pop(user_id_str, None)
+        for key in ('card_points', 'card_names', 'journal'):
+            if key in changes:
+                data[key] = changes[key]
+        self.storage.save(data)
+        return data
+    
+    def snapshot_saved(self, data):
+        if self.journal:
+            self.backup_lsn = self.snapshot_lsn
+            self.snapshot_lsn = data['journal'][self.journal.name]
+    
+    def get_checkpoint_lsn(self):
+        return self.backup_lsn if self.storage.backup else self.snapshot_lsn
     
     def save_user_data(self):
         try:
-            current_dir = os.path.dirname(os.path.abspath(__file__))
-            data_path = os.path.join(current_dir, DATA_FILE)
-            
-            user_cards_data = {}
-            for user_id, cards_list in self.user_cards.items():
-                user_cards_data[str(user_id)] = cards_list
-            
-            cooldowns_data = {}
-            for user_id, cooldown_time in self.user_cooldowns.items():
-                cooldowns_data[str(user_id)] = cooldown_time.isoformat() if cooldown_time else None
-            
-            vsrakost_data = {}
-            for user_id, vsrakost_points in self.user_vsrakost.items():
-                vsrakost_data[str(user_id)] = vsrakost_points
-            
-            names_data = {}
-            for user_id, name in self.user_names.items():
-                names_data[str(user_id)] = name
-            
-            card_points_data = self.card_points.copy()
+            self.dirty_users.clear()
+            self.cards_dirty = False
+            data = self.snapshot_user_data()
+            self.storage.save(data)
+            if not self.storage.incremental:
+                self.snapshot_base = data
+            self.snapshot_saved(data)
+            if self.journal:
+                self.journal.checkpoint(self.get_checkpoint_lsn())
+            logger.info("Данные сохранены: %s пользователей, %s карт с очками", len(self.user_cards), len(self.card_points))
+        except Exception as e:
+            logger.error("Ошибка при сохранении данных: %s", e)
+    
+    def mark_dirty(self, user_id):
+        if not self.owns(user_id):
+            metrics.inc('shard.foreign_writes')
+            logger.warning("Воркер %s не владеет пользователем %s, изменения не сохраняются", self.shard[0], user_id)
+            return
+        self.dirty_users.add(user_id)
+        if self.save_event and (self.storage.incremental or len(self.dirty_users) >= SAVE_BATCH_SIZE):
+            self.save_event.set()
+    
+    async def flush_user_data(self):
+        if not self.dirty_users and not self.cards_dirty:
+            return
+        
+        dirty = self.dirty_users
+        self.dirty_users = set()
+        self.saving_users = dirty
+        self.cards_dirty = False
+        if self.storage.incremental or self.snapshot_base is not None:
+            data = self.snapshot_user_data(dirty)
+        else:
+            data = self.snapshot_user_data()
+        
+        try:
+            with metrics.timer('save'):
+                if self.storage.incremental:
+                    await asyncio.to_thread(self.storage.save, data)
+                elif self.snapshot_base is not None:
+                    data = await asyncio.to_thread(self.save_snapshot_changes, dirty, data)
+                else:
+                    await asyncio.to_thread(self.storage.save, data)
+                    self.snapshot_base = data
+            self.snapshot_saved(data)
+            logger.debug("Данные сохранены: %s изменённых пользователей", len(dirty))
+        except Exception as e:
+            self.dirty_users |= dirty
+            self.cards_dirty = True
+            logger.error("Ошибка при сохранении данных: %s", e)
+        finally:
+            self.saving_users = set()
+        
+        if self.journal and self.journal.size() >= JOURNAL_CHECKPOINT_BYTES:
+            await self.checkpoint_journal()
+    
+    async def checkpoint_journal(self):
+        try:
+            await asyncio.to_thread(self.journal.checkpoint, self.get_checkpoint_lsn())
+        except Exception as e:
+            logger.error("Ошибка при сжатии журнала %s: %s", self.journal.path, e)
+    
+    async def sync_journal(self):
+        if self.journal:
+            await self.journal.wait(self.journal.lsn)
+    
+    async def run_saver(self):
+        while not self.saver_stopping:
+            try:
+                await asyncio.wait_for(self.save_event.wait(), timeout=SAVE_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self.save_event.clear()
+            await self.flush_user_data()
+    
+    async def start_saver(self, application: Application):
+        self.saver_stopping = False
+        self.save_event = asyncio.Event()
+        self.save_task = asyncio.create_task(self.run_saver())
+        if self.journal:
+            self.journal.start()
+    
+    async def stop_saver(self, application: Application):
+        if self.save_task:
+            self.saver_stopping = True
+            self.save_event.set()
+            await self.save_task
+            self.save_task = None
+        if self.journal:
+            await self.journal.stop()
+        await self.flush_user_data()
+        if self.journal:
+            await self.checkpoint_journal()
+            self.journal.close()
+        self.storage.close()
+    
+    def load_file_id_cache(self):
+        try:
+            self.card_file_ids = self.file_id_cache.load() or {}
+            logger.info("Загружены file_id для %s карт", len(self.card_file_ids))
+        except Exception as e:
+            logger.error("Ошибка при загрузке кэша file_id: %s", e)
+            self.card_file_ids = {}
+    
+    def get_card_path(self, card_name):
+        if card_name in self.prepared_cards:
+            return self.prepared_cards[card_name]
+        return os.path.join(self.cards_path, card_name)
+    
+    def get_cached_file_id(self, card_name, stat):
+        cached = self.card_file_ids.get(card_name)
+        if not cached:
+            return None
+        if cached['mtime'] != stat.st_mtime_ns or cached['size'] != stat.st_size:
+            return None
+        return cached['file_id']
+    
+    def build_card_index(self, cards):
+        index = {}
+        budget = CARD_PRELOAD_TOTAL
+        for card_name in cards:
+            path = self.get_card_path(card_name)
+            points = self.card_points.get(card_name, 0)
+            previous = self.card_index.get(card_name)
+            try:
+                stat = os.stat(path)
+                if (previous and previous.path == path and previous.points == points
+                        and previous.mtime_ns == stat.st_mtime_ns and previous.size == stat.st_size):
+                    index[card_name] = previous
+                    budget -= len(previous.data or b'')
+                    continue
+                stat, digest, data = load_card_file(path, CARD_PRELOAD_BYTES if budget > 0 else -1)
+            except OSError as e:
+                logger.warning("Не удалось прочитать карту %s: %s", card_name, e)
+                continue
             
-            data = {
-                'user_cards': user_cards_data,
-                'user_cooldowns': cooldowns_data,
-                'user_vsrakost': vsrakost_data,
-                'user_names': names_data,
-                'card_points': card_points_data
+            budget -= len(data or b'')
+            index[card_name] = CardRecord(
+                self.card_ids[card_name], card_name, path, stat.st_size, stat.st_mtime_ns, digest,
+                mimetypes.guess_type(path)[0] or 'application/octet-stream', points,
+                self.get_cached_file_id(card_name, stat), data
+            )
+        return index
+    
+    def index_cards(self):
+        self.card_index = self.build_card_index(self.cards_list)
+        preloaded = [record for record in self.card_index.values() if record.data is not None]
+        logger.info("Индекс карт: %s записей, в памяти %s карт (%.1f МБ)",
+                    len(self.card_index), len(preloaded), sum(record.size for record in preloaded) / (1024 * 1024))
+    
+    def get_card(self, card_name):
+        return self.card_index.get(card_name)
+    
+    async def update_file_id_cache(self, record, file_id):
+        record.file_id = file_id
+        if file_id is None:
+            if self.card_file_ids.pop(record.name, None) is None:
+                return
+        else:
+            self.card_file_ids[record.name] = {
+                'file_id': file_id,
+                'mtime': record.mtime_ns,
+                'size': record.size
             }
-            
-            with open(data_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            
-            total_cards = sum(len(cards) for cards in self.user_cards.values())
-            total_points = sum(self.user_vsrakost.values())
-            print(f"Данные сохранены: {len(self.user_cards)} пользователей, {total_cards} карт, {total_points} очков")
-            print(f"Сохранены очки для {len(self.card_points)} карт")
-            
+        
+        try:
+            await asyncio.to_thread(self.file_id_cache.save, dict(self.card_file_ids))
         except Exception as e:
-            print(f"Ошибка при сохранении данных: {e}")
+            logger.error("Ошибка при сохранении кэша file_id: %s", e)
     
-    def get_random_card(self):
-        if not self.cards_list:
-            return None
-        return random.choice(self.cards_list)
+    async def send_card(self, message, card_name, caption):
+        record = self.get_card(card_name)
+        if record is None:
+            raise FileNotFoundError(card_name)
+        
+        if record.file_id:
+            try:
+                with metrics.timer('send_card.file_id'):
+                    return await message.reply_photo(photo=record.file_id, caption=caption)
+            except BadRequest as e:
+                metrics.inc('send_card.stale_file_id')
+                logger.warning("Telegram отклонил file_id карты %s: %s, загружаем заново", card_name, e)
+                await self.update_file_id_cache(record, None)
+        
+        photo = record.data
+        if photo is None:
+            photo = await asyncio.to_thread(read_file, record.path)
+        else:
+            metrics.inc('send_card.preloaded')
+        with metrics.timer('send_card.upload'):
+            sent = await message.reply_photo(photo=photo, caption=caption)
+        
+        if sent and sent.photo:
+            await self.update_file_id_cache(record, sent.photo[-1].file_id)
+        return sent
+    
+    def get_card_weight(self, card_name):
+        if card_name in CARD_WEIGHTS:
+            return CARD_WEIGHTS[card_name]
+        
+        points = self.card_points.get(card_name, 0)
+        for min_points, weight in RARITY_TIERS:
+            if points >= min_points:
+                return weight
+        return 1
+    
+    def rebuild_drop_table(self):
+        weights = {card: self.get_card_weight(card) for card in self.cards_list}
+        rare_cards = [card for card in self.cards_list if self.card_points.get(card, 0) >= PITY_MIN_POINTS]
+        self.drop_engine.build(weights, rare_cards)
+    
+    def get_random_card(self, user_id=None):
+        return self.drop_engine.draw(user_id)
+    
+    def get_cooldown_left(self, user_id, now=None):
+        cooldown = self.user_cooldowns.get(user_id)
+        if cooldown is None:
+            return 0.0
+        return max(0.0, cooldown_due(cooldown) - (now or time.time()))
+    
+    def get_time_left(self, seconds_left):
+        return int(seconds_left // 60), int(seconds_left % 60)
     
     def can_open_card(self, user_id):
-        if user_id not in self.user_cooldowns:
-            return True, None
+        self.ensure_user(user_id)
+        seconds_left = self.get_cooldown_left(user_id)
+        if seconds_left:
+            return False, self.get_time_left(seconds_left)
+        return True, None
+    
+    async def try_acquire_drop(self, user_id):
+        self.ensure_user(user_id)
+        now = time.time()
+        seconds_left = self.get_cooldown_left(user_id, now)
+        if seconds_left:
+            return False, self.get_time_left(seconds_left)
         
-        last_open_time = self.user_cooldowns[user_id]
-        cooldown_end = last_open_time + timedelta(minutes=COOLDOWN_MINUTES)
-        now = datetime.now()
+        if user_id in self.pending_drops:
+            return False, self.get_time_left(COOLDOWN_MINUTES * 60)
         
-        if now < cooldown_end:
-            time_left = cooldown_end - now
-            minutes_left = int(time_left.total_seconds() // 60)
-            seconds_left = int(time_left.total_seconds() % 60)
-            return False, (minutes_left, seconds_left)
+        previous = self.user_cooldowns.get(user_id)
+        self.pending_drops[user_id] = previous
+        if self.shard:
+            try:
+                claimed = await asyncio.to_thread(self.storage.claim_cooldown, user_id, now, now - COOLDOWN_MINUTES * 60)
+                record = None if claimed else await asyncio.to_thread(self.storage.load_user, user_id)
+            except Exception:
+                self.pending_drops.pop(user_id, None)
+                raise
+            if not claimed:
+                metrics.inc('drop.claim_conflicts')
+                self.pending_drops.pop(user_id, None)
+                if record and record['cooldown'] is not None:
+                    self.user_cooldowns[user_id] = record['cooldown']
+                return False, self.get_time_left(self.get_cooldown_left(user_id, now))
         
+        self.user_cooldowns[user_id] = now
         return True, None
     
-    def set_cooldown(self, user_id, application: Application = None):
-        self.user_cooldowns[user_id] = datetime.now()
-        self.save_user_data()
-        
-        if application:
-            self.schedule_notification(user_id, application)
+    def complete_drop(self, user_id):
+        self.pending_drops.pop(user_id, None)
+        self.mark_dirty(user_id)
+        self.notifier.schedule(user_id, self.get_cooldown_due(user_id))
     
-    def schedule_notification(self, user_id: int, application: Application):
-        if user_id in self.user_notifications:
+    async def release_drop(self, user_id):
+        if user_id not in self.pending_drops:
+            return
+        previous = self.pending_drops.pop(user_id)
+        reserved = self.user_cooldowns.pop(user_id, None)
+        if previous is not None:
+            self.user_cooldowns[user_id] = previous
+        metrics.inc('drop.released')
+        if self.shard:
             try:
-                self.user_notifications[user_id].schedule_removal()
-                del self.user_notifications[user_id]
+                await asyncio.to_thread(self.storage.release_cooldown, user_id, reserved, previous)
             except Exception as e:
-                print(f"Ошибка при отмене предыдущего уведомления: {e}")
+                metrics.inc('drop.release_errors')
+                logger.error("Не удалось вернуть таймер пользователя %s: %s", user_id, e)
+    
+    def get_cooldown_due(self, user_id):
+        return cooldown_due(self.user_cooldowns[user_id])
+    
+    def rebuild_notifications(self):
+        self.notifier = NotificationScheduler()
+        missed_limit = time.time() - NOTIFY_MISSED_LIMIT_MINUTES * 60
         
-        job_queue = application.job_queue
-        if job_queue:
-            cooldown_end = self.user_cooldowns[user_id] + timedelta(minutes=COOLDOWN_MINUTES)
-            now = datetime.now()
-            delay = (cooldown_end - now).total_seconds()
-            
-            if delay > 0:
-                job = job_queue.run_once(
-                    callback=lambda context: self.send_notification(context, user_id),
-                    when=delay,
-                    name=f"cooldown_notification_{user_id}"
-                )
-                self.user_notifications[user_id] = job
+        if self.storage.lazy:
+            cooldowns = ((user_id, cooldown) for user_id, cooldown in self.storage.load_cooldowns() if self.owns(user_id))
+        else:
+            cooldowns = self.user_cooldowns.items()
+        
+        expired = []
+        for user_id, cooldown in cooldowns:
+            due = cooldown_due(cooldown)
+            if due < missed_limit:
+                expired.append(user_id)
+            else:
+                self.notifier.schedule(user_id, due)
+        
+        if self.storage.lazy:
+            self.storage.clear_cooldowns(expired)
+        else:
+            for user_id in expired:
+                del self.user_cooldowns[user_id]
+                self.mark_dirty(user_id)
+        
+        logger.info("Запланировано уведомлений: %s, устаревших таймеров удалено: %s", len(self.notifier), len(expired))
     
-    async def send_notification(self, context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    def start_notifier(self, application: Application):
+        self.notifier.start(lambda user_id, due: self.send_notification(application.bot, user_id, due))
+    
+    async def send_notification(self, bot, user_id: int, due: float):
         try:
-            if user_id in self.user_notifications:
-                del self.user_notifications[user_id]
-            
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="Таймер окончен! Теперь ты можешь открыть следующую карту!\n\nИспользуй команду /drop чтобы получить новую SRAKY!"
+            await self.outbound.send(
+                user_id,
+                lambda: bot.send_message(
+                    chat_id=user_id,
+                    text="Таймер окончен! Теперь ты можешь открыть следующую карту!\n\nИспользуй команду /drop чтобы получить новую SRAKY!"
+                ),
+                priority=PRIORITY_NOTIFY
             )
-            print(f"Уведомление отправлено пользователю {user_id}")
+            logger.debug("Уведомление отправлено пользователю %s", user_id)
             
         except Exception as e:
-            print(f"Ошибка при отправке уведомления пользователю {user_id}: {e}")
+            logger.error("Ошибка при отправке уведомления пользователю %s: %s", user_id, e)
+        
+        self.ensure_user(user_id)
+        if user_id in self.user_cooldowns and self.get_cooldown_due(user_id) == due:
+            del self.user_cooldowns[user_id]
+            self.mark_dirty(user_id)
     
     def add_card_to_user(self, user_id, card_name):
+        card_points = self.card_points.get(card_name, 0)
+        self.apply_drop(user_id, card_name, card_points)
+        if self.journal:
+            self.journal.append({'t': 'drop', 'u': user_id, 'c': card_name, 'p': card_points, 'at': self.user_cooldowns.get(user_id)})
+        return card_points
+    
+    def apply_drop(self, user_id, card_name, card_points):
+        self.ensure_user(user_id)
         if user_id not in self.user_cards:
-            self.user_cards[user_id] = []
+            self.user_cards[user_id] = array('I')
+            self.user_card_totals[user_id] = 0
         
-        self.user_cards[user_id].append(card_name)
+        card_id = self.intern_card(card_name)
+        counts = self.user_cards[user_id]
+        if card_id >= len(counts):
+            counts.extend([0] * (card_id + 1 - len(counts)))
+        counts[card_id] += 1
+        self.user_card_totals[user_id] += 1
         
-        card_points = self.card_points.get(card_name, 0)
         if user_id not in self.user_vsrakost:
             self.user_vsrakost[user_id] = 0
         
         old_points = self.user_vsrakost[user_id]
         self.user_vsrakost[user_id] += card_points
         new_points = self.user_vsrakost[user_id]
+        if self.ranking:
+            self.ranking.update(user_id, new_points)
+        self.touch_top(user_id, new_points)
         
-        print(f"Добавлена карта {card_name} пользователю {user_id}")
-        print(f"Начислено {card_points} очков VSRAKOSTI за карту {card_name}")
-        print(f"У пользователя {user_id}: было {old_points} очков, стало {new_points} очков")
-        print(f"Всего карт у пользователя {user_id}: {len(self.user_cards[user_id])}")
+        logger.debug("Добавлена карта %s пользователю %s", card_name, user_id)
+        logger.debug("Начислено %s очков VSRAKOSTI за карту %s", card_points, card_name)
+        logger.debug("У пользователя %s: было %s очков, стало %s очков", user_id, old_points, new_points)
+        logger.debug("Всего карт у пользователя %s: %s", user_id, self.user_card_totals[user_id])
         
-        self.save_user_data()
-        return card_points
+        self.mark_dirty(user_id)
     
     def update_user_name(self, user_id, first_name, last_name=None):
         full_name = first_name
         if last_name:
             full_name = f"{first_name} {last_name}"
         
+        self.ensure_user(user_id)
         if user_id not in self.user_names or self.user_names[user_id] != full_name:
             self.user_names[user_id] = full_name
-            print(f"Обновлено имя пользователя {user_id}: '{full_name}'")
-            self.save_user_data()
+            logger.debug("Обновлено имя пользователя %s: '%s'", user_id, full_name)
+            self.mark_dirty(user_id)
+            if self.journal:
+                self.journal.append({'t': 'name', 'u': user_id, 'n': full_name})
+            if self.top_cache and user_id in self.top_cache['user_ids']:
+                self.invalidate_top()
         
         return full_name
     
     def get_user_display_name(self, user_id, update: Update = None):
+        self.ensure_user(user_id)
         if user_id in self.user_names:
             return self.user_names[user_id]
         
@@ -297,55 +2466,122 @@ class CardBot:
         
         return f"Игрок_{user_id}"
     
+    def get_user_name(self, user_id):
+        if not self.owns(user_id):
+            return self.load_user_names([user_id])[user_id]
+        self.ensure_user(user_id)
+        return self.user_names.get(user_id, f"Игрок_{user_id}")
+    
+    def load_user_names(self, user_ids):
+        names = {}
+        for user_id in user_ids:
+            record = self.storage.load_user(user_id)
+            names[user_id] = record['name'] if record and record['name'] else f"Игрок_{user_id}"
+        return names
+    
+    def get_user_points(self, user_id):
+        self.ensure_user(user_id)
+        return self.user_vsrakost.get(user_id, 0)
+    
     def get_user_vsrakost_rank(self, user_id):
+        self.ensure_user(user_id)
         if user_id not in self.user_vsrakost:
             return None
         
-        sorted_users = sorted(self.user_vsrakost.items(), key=lambda x: x[1], reverse=True)
-        for rank, (uid, points) in enumerate(sorted_users, 1):
-            if uid == user_id:
-                return rank
-        return None
+        if self.storage.indexed:
+            return self.storage.get_vsrakost_rank(self.user_vsrakost[user_id])
+        return self.ranking.rank(user_id)
     
     def get_top_users(self, limit=10):
-        sorted_users = sorted(self.user_vsrakost.items(), key=lambda x: x[1], reverse=True)
-        return sorted_users[:limit]
+        if not self.storage.indexed:
+            return self.ranking.top(limit)
+        
+        pending = self.dirty_users | self.saving_users
+        top_users = dict(self.storage.get_top_users(limit + len(pending)))
+        for user_id in pending:
+            if user_id in self.user_vsrakost:
+                top_users[user_id] = self.user_vsrakost[user_id]
+        return sorted(top_users.items(), key=lambda item: (-item[1], item[0]))[:limit]
+    
+    def invalidate_top(self):
+        self.top_version += 1
+        self.top_cache = None
+    
+    def touch_top(self, user_id, points):
+        top = self.top_cache
+        if top is None:
+            return
+        if user_id in top['user_ids'] or len(top['user_ids']) < TOP_LIMIT or (points, -user_id) > top['cutoff']:
+            self.invalidate_top()
+    
+    async def get_top_message(self):
+        data_version = await asyncio.to_thread(self.storage.data_version) if self.shard else None
+        if self.top_cache is not None and self.top_cache['data_version'] != data_version:
+            self.invalidate_top()
+        if self.top_cache is not None:
+            metrics.inc('top.cache_hits')
+            return self.top_cache['message']
+        
+        version = self.top_version
+        top_users = self.get_top_users(limit=TOP_LIMIT)
+        foreign = [user_id for user_id, points in top_users if not self.owns(user_id)]
+        foreign_names = await asyncio.to_thread(self.load_user_names, foreign) if foreign else {}
+        
+        message = f"ТОП-{TOP_LIMIT} ИГРОКОВ ПО VSRAKOSTI\n\n"
+        
+        if top_users:
+            for i, (user_id, points) in enumerate(top_users, 1):
+                display_name = foreign_names[user_id] if user_id in foreign_names else self.get_user_name(user_id)
+                
+                medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
+                message += f"{medal} {display_name} - {points} очков\n"
+        else:
+            message += "Пока никто не заработал очков...\n"
+        
+        if version != self.top_version:
+            return message
+        last_user_id, last_points = top_users[-1] if top_users else (0, 0)
+        self.top_cache = {
+            'version': version,
+            'data_version': data_version,
+            'message': message,
+            'user_ids': {user_id for user_id, points in top_users},
+            'cutoff': (last_points, -last_user_id)
+        }
+        return message
     
     def get_user_cards_count(self, user_id):
-        if user_id not in self.user_cards:
-            return 0
-        return len(self.user_cards[user_id])
+        self.ensure_user(user_id)
+        return self.user_card_totals.get(user_id, 0)
     
     def get_user_cards_list(self, user_id):
+        self.ensure_user(user_id)
         if user_id not in self.user_cards:
             return []
-        return self.user_cards[user_id]
+        return [(self.card_names[card_id], count) for card_id, count in enumerate(self.user_cards[user_id]) if count]
     
     def get_total_cards_count(self):
         return len(self.cards_list)
     
     def get_cooldown_time(self, user_id):
-        if user_id not in self.user_cooldowns:
-            return None
-        
-        last_open_time = self.user_cooldowns[user_id]
-        cooldown_end = last_open_time + timedelta(minutes=COOLDOWN_MINUTES)
-        now = datetime.now()
-        
-        if now >= cooldown_end:
+        self.ensure_user(user_id)
+        seconds_left = self.get_cooldown_left(user_id)
+        if not seconds_left:
             return None
-        
-        time_left = cooldown_end - now
-        return time_left
+        return timedelta(seconds=seconds_left)
+
+card_bot = None
 
-card_bot = CardBot()
+async def reply_text(update: Update, text, coalesce_key=None):
+    return await card_bot.outbound.send(update.effective_chat.id, lambda: update.message.reply_text(text), coalesce_key=coalesce_key)
 
+@instrumented("start")
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user_name = card_bot.get_user_display_name(user_id, update)
     total_cards = card_bot.get_total_cards_count()
     user_cards_count = card_bot.get_user_cards_count(user_id)
-    user_points = card_bot.user_vsrakost.get(user_id, 0)
+    user_points = card_bot.get_user_points(user_id)
     
     can_open, time_left = card_bot.can_open_card(user_id)
     
@@ -360,70 +2596,89 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     welcome_text += "Доступные команды:\n/drop - Получить карту\n/list - Моя коллекция\n/top - Топ игроков"
     
-    await update.message.reply_text(welcome_text)
+    await reply_text(update, welcome_text)
 
+@instrumented("drop")
 async def drop_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user_name = card_bot.get_user_display_name(user_id, update)
     
-    can_open, time_left = card_bot.can_open_card(user_id)
-    if not can_open:
+    await open_card(update, context, user_id, user_name)
+
+async def open_card(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, user_name: str):
+    try:
+        acquired, time_left = await card_bot.try_acquire_drop(user_id)
+    except Exception as e:
+        logger.error("Не удалось занять таймер пользователя %s: %s", user_id, e)
+        await reply_text(update, "Ошибка при открытии карты, попробуйте ещё раз")
+        return
+    if not acquired:
         mins, secs = time_left
-        await update.message.reply_text(
+        await reply_text(
+            update,
             f"{user_name}, следующую карту можно открыть через:\n"
             f"{mins} минут {secs} секунд\n\n"
             f"Таймер: {COOLDOWN_MINUTES} минут между открытиями"
         )
         return
     
-    card = card_bot.get_random_card()
+    card = card_bot.get_random_card(user_id)
     
     if not card:
-        await update.message.reply_text(
+        await card_bot.release_drop(user_id)
+        await reply_text(
+            update,
             "Карты не найдены!\n"
-            "Добавьте картинки в папку cards и перезапустите бота"
+            "Добавьте картинки в папку cards, бот подхватит их автоматически"
         )
         return
     
-    card_points = card_bot.card_points.get(card, 0)
+    record = card_bot.get_card(card)
+    card_points = record.points if record else card_bot.card_points.get(card, 0)
     
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    card_path = os.path.join(current_dir, CARDS_FOLDER, card)
-    
-    print(f"Пытаюсь отправить карту: {card} пользователю {user_id} ({user_name})")
-    print(f"Карта дает {card_points} очков")
+    logger.debug("Пытаюсь отправить карту: %s пользователю %s (%s)", card, user_id, user_name)
+    logger.debug("Карта дает %s очков", card_points)
     
+    caption = f"Новая SRAKA!\nДаёт очков: {card_points}\nСледующая карта через {COOLDOWN_MINUTES} минут"
     try:
-        if not os.path.exists(card_path):
-            await update.message.reply_text(f"Файл карты не найден: {card}")
-            print(f"Файл не существует: {card_path}")
+        await card_bot.outbound.send(update.effective_chat.id, lambda: card_bot.send_card(update.message, card, caption=caption), resend=False)
+    except FileNotFoundError:
+        await card_bot.release_drop(user_id)
+        await reply_text(update, f"Файл карты не найден: {card}")
+        logger.warning("Файл не существует: %s", card_bot.get_card_path(card))
+        return
+    except NetworkError as e:
+        if isinstance(e, BadRequest) or request_not_sent(e):
+            await card_bot.release_drop(user_id)
+            logger.error("Ошибка при отправке карты %s: %s", card, e)
+            await reply_text(update, "Ошибка при отправке карты")
             return
-        
-        with open(card_path, 'rb') as photo:
-            await update.message.reply_photo(
-                photo=photo,
-                caption=f"Новая SRAKA!\nДаёт очков: {card_points}\nСледующая карта через {COOLDOWN_MINUTES} минут"
-            )
-        
-        card_bot.set_cooldown(user_id, context.application)
+        metrics.inc('drop.ambiguous_sends')
+        logger.warning("Неизвестно, дошла ли карта %s до пользователя %s, считаем доставленной: %s", card, user_id, e)
+    except Exception as e:
+        await card_bot.release_drop(user_id)
+        logger.error("Ошибка при отправке карты %s: %s", card, e)
+        await reply_text(update, "Ошибка при отправке карты")
+        return
+    
+    card_bot.complete_drop(user_id)
+    try:
         earned_points = card_bot.add_card_to_user(user_id, card)
-        
-        user_total_points = card_bot.user_vsrakost.get(user_id, 0)
-        user_rank = card_bot.get_user_vsrakost_rank(user_id)
-        
-        print(f"Успешно отправлена карта: {card} пользователю {user_id}, начислено {earned_points} очков")
-        
+        await card_bot.sync_journal()
     except Exception as e:
-        error_msg = f"Ошибка при отправке карты {card}: {e}"
-        print(error_msg)
-        await update.message.reply_text("Ошибка при отправке карты")
+        metrics.inc('drop.record_errors')
+        logger.error("Карта %s доставлена пользователю %s, но не записана: %s", card, user_id, e)
+        return
+    
+    logger.info("Успешно отправлена карта: %s пользователю %s, начислено %s очков", card, user_id, earned_points)
 
+@instrumented("list")
 async def list_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user_name = card_bot.get_user_display_name(user_id, update)
     user_cards_count = card_bot.get_user_cards_count(user_id)
     total_cards_count = card_bot.get_total_cards_count()
-    user_points = card_bot.user_vsrakost.get(user_id, 0)
+    user_points = card_bot.get_user_points(user_id)
     user_rank = card_bot.get_user_vsrakost_rank(user_id)
     
     cooldown_time = card_bot.get_cooldown_time(user_id)
@@ -445,73 +2700,208 @@ async def list_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         message += "Можешь открыть следующую карту! Используй /drop"
     
-    await update.message.reply_text(message)
+    await reply_text(update, message)
 
+@instrumented("top")
 async def top_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    top_users = card_bot.get_top_users(limit=10)
+    chat_id = update.effective_chat.id
+    await reply_text(update, await card_bot.get_top_message(), coalesce_key=('top', chat_id))
+
+async def post_init(application: Application):
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="sraka-io"))
+    await card_bot.start_saver(application)
+    card_bot.outbound.start()
+    card_bot.start_notifier(application)
+    card_bot.start_watcher()
     
-    message = "ТОП-10 ИГРОКОВ ПО VSRAKOSTI\n\n"
+    if METRICS_PORT:
+        port = METRICS_PORT + card_bot.shard[0] + 1 if card_bot.shard else METRICS_PORT
+        application.bot_data['metrics_server'] = await metrics.serve(port=port)
+    try:
+        loop.add_signal_handler(signal.SIGUSR1, metrics.dump)
+    except (NotImplementedError, AttributeError):
+        pass
+
+async def post_shutdown(application: Application):
+    metrics.dump()
+    server = application.bot_data.pop('metrics_server', None)
+    if server:
+        server.close()
+        await server.wait_closed()
+    await card_bot.stop_watcher()
+    await card_bot.notifier.stop()
+    await card_bot.outbound.stop()
+    await card_bot.stop_saver(application)
+
+def build_application(updater=True):
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if not updater:
+        builder = builder.updater(None)
+    application = builder.build()
     
-    if top_users:
-        for i, (user_id, points) in enumerate(top_users, 1):
-            if user_id in card_bot.user_names:
-                display_name = card_bot.user_names[user_id]
-            else:
-                display_name = f"Игрок_{user_id}"
-            
-            medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-            message += f"{medal} {display_name} - {points} очков\n"
-    else:
-        message += "Пока никто не заработал очков...\n"
+    application.add_handler(CommandHandler("start", start_command))
+    application.add_handler(CommandHandler("drop", drop_command))
+    application.add_handler(CommandHandler("list", list_command))
+    application.add_handler(CommandHandler("top", top_command))
+    return application
+
+async def process_shard_updates(application, updates):
+    async with application:
+        await post_init(application)
+        await application.start()
+        try:
+            while True:
+                update_data = await asyncio.to_thread(updates.get)
+                if update_data is None:
+                    break
+                data = json.loads(update_data)
+                user_id = update_user_id(data)
+                if not card_bot.owns(user_id):
+                    metrics.inc('shard.misrouted')
+                    logger.warning("Обновление пользователя %s пришло не в свой воркер, пропускаем", user_id)
+                    continue
+                await application.update_queue.put(Update.de_json(data, application.bot))
+                metrics.inc('shard.updates')
+        finally:
+            await application.stop()
+            await post_shutdown(application)
+
+def run_shard_worker(shard_index, shard_count, updates):
+    global card_bot
+    setup_logging()
+    card_bot = CardBot(shard=(shard_index, shard_count))
+    logger.info("Воркер %s из %s запущен", shard_index + 1, shard_count)
+    asyncio.run(process_shard_updates(build_application(updater=False), updates))
+
+async def handle_webhook(reader, writer, queues):
+    status = b'200 OK'
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+        headers = {}
+        for line in head.decode('latin-1').split('\r\n')[1:]:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+        
+        if WEBHOOK_SECRET and headers.get('x-telegram-bot-api-secret-token') != WEBHOOK_SECRET:
+            status = b'403 Forbidden'
+        else:
+            update_data = json.loads(body)
+            if not isinstance(update_data, dict):
+                raise ValueError("обновление должно быть JSON-объектом")
+            user_id = update_user_id(update_data)
+            queues[shard_for_user(user_id, len(queues))].put_nowait(body)
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError, KeyError, TypeError) as e:
+        status = b'400 Bad Request'
+        logger.warning("Некорректный запрос вебхука: %s", e)
+    
+    try:
+        writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def serve_webhook(queues):
+    async with Bot(BOT_TOKEN) as bot:
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None)
     
-    await update.message.reply_text(message)
+    server = await asyncio.start_server(lambda reader, writer: handle_webhook(reader, writer, queues), WEBHOOK_HOST, WEBHOOK_PORT)
+    logger.info("Вебхук слушает %s:%s, воркеров: %s", WEBHOOK_HOST, WEBHOOK_PORT, len(queues))
+    async with server:
+        await server.serve_forever()
+
+def run_sharded(shard_count):
+    if STORAGE_BACKEND != "sqlite":
+        logger.error("Режим с несколькими воркерами требует STORAGE_BACKEND = \"sqlite\"")
+        return
+    if not WEBHOOK_URL:
+        logger.error("Укажите WEBHOOK_URL для режима с несколькими воркерами")
+        return
+    
+    coordinator = CardBot()
+    coordinator.save_user_data()
+    coordinator.storage.close()
+    
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for _ in range(shard_count)]
+    workers = [
+        context.Process(target=run_shard_worker, args=(shard_index, shard_count, queues[shard_index]), name=f"sraka-shard-{shard_index}")
+        for shard_index in range(shard_count)
+    ]
+    for worker in workers:
+        worker.start()
+    
+    try:
+        asyncio.run(serve_webhook(queues))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for updates in queues:
+            updates.put(None)
+        for worker in workers:
+            worker.join()
 
 def main():
+    global card_bot
+    setup_logging()
+    
+    if len(sys.argv) > 1 and sys.argv[1] == 'prepare':
+        card_bot = CardBot()
+        card_bot.prepare_cards()
+        return
+    
+    if len(sys.argv) > 1 and sys.argv[1] == 'export':
+        out_dir = sys.argv[2] if len(sys.argv) > 2 else os.path.join(BASE_DIR, EXPORT_FOLDER)
+        storage = create_storage()
+        try:
+            export_collections(storage, out_dir)
+        finally:
+            storage.close()
+        return
+    
     if BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
-        print("ERROR: Замените BOT_TOKEN на ваш настоящий токен бота!")
+        logger.error("Замените BOT_TOKEN на ваш настоящий токен бота!")
         return
     
+    if SHARD_WORKERS:
+        run_sharded(SHARD_WORKERS)
+        return
+    
+    card_bot = CardBot()
+    
     total_cards = card_bot.get_total_cards_count()
     if total_cards == 0:
-        print("ВНИМАНИЕ: Карты не найдены!")
-        print("Решение:")
-        print("   1. Создайте папку 'cards' рядом с файлом бота")
-        print("   2. Добавьте в нее картинки (PNG, JPG, JPEG, GIF, WEBP)")
-        print("   3. Перезапустите бота")
+        logger.warning("ВНИМАНИЕ: Карты не найдены!")
+        logger.warning("Решение:")
+        logger.warning("   1. Создайте папку 'cards' рядом с файлом бота")
+        logger.warning("   2. Добавьте в нее картинки (PNG, JPG, JPEG, GIF, WEBP)")
+        logger.warning("   3. Перезапустите бота")
     else:
-        print(f"Готов к работе! Загружено карт: {total_cards}")
-        print(f"Таймер между открытиями: {COOLDOWN_MINUTES} минут")
-        print(f"Система очков VSRAKOSTI: ВКЛЮЧЕНА")
-        print(f"Автоматические имена из Telegram: ВКЛЮЧЕНО")
-        print(f"Сохранение очков карт: ВКЛЮЧЕНО")
-        
-        print(f"\nПримеры карт с очками:")
-        sample_cards = list(card_bot.card_points.items())[:5]
-        for i, (card, points) in enumerate(sample_cards, 1):
-            print(f"   {i}. {card} - {points} очков")
-        
-        total_card_points = sum(card_bot.card_points.values())
-        avg_points = total_card_points / len(card_bot.card_points) if card_bot.card_points else 0
-        print(f"\nСтатистика очков:")
-        print(f"   Всего очков у всех карт: {total_card_points}")
-        print(f"   Среднее очков на карту: {avg_points:.1f}")
-        print(f"   Максимальное очков: {max(card_bot.card_points.values()) if card_bot.card_points else 0}")
-        print(f"   Минимальное очков: {min(card_bot.card_points.values()) if card_bot.card_points else 0}")
+        logger.info("Готов к работе! Загружено карт: %s", total_cards)
+        logger.info("Таймер между открытиями: %s минут", COOLDOWN_MINUTES)
+        logger.info("Система очков VSRAKOSTI: ВКЛЮЧЕНА")
+        logger.info("Автоматические имена из Telegram: ВКЛЮЧЕНО")
+        logger.info("Сохранение очков карт: ВКЛЮЧЕНО")
     
     try:
-        application = Application.builder().token(BOT_TOKEN).build()
-        
-        application.add_handler(CommandHandler("start", start_command))
-        application.add_handler(CommandHandler("drop", drop_command))
-        application.add_handler(CommandHandler("list", list_command))
-        application.add_handler(CommandHandler("top", top_command))
+        application = build_application()
         
-        print("Бот запускается...")
-        print("Используйте /start в Telegram для начала работы")
+        logger.info("Бот запускается...")
+        logger.info("Используйте /start в Telegram для начала работы")
         application.run_polling()
         
     except Exception as e:
-        print(f"Ошибка при запуске бота: {e}")
+        logger.error("Ошибка при запуске бота: %s", e)
 
 if __name__ == '__main__':
     main()